@@ -22,12 +22,47 @@ Python API for reading the Amateur Data Interchange Format, aka ADIF.
 ADIF version 1.0 is supported.
 """
 
-from collections import namedtuple, OrderedDict
+from array import array
+from collections import namedtuple, Mapping, OrderedDict
+import cPickle
 from decimal import Decimal
-from datetime import datetime
+from datetime import date, datetime, time
+import logging
+import marshal
+from mmap import mmap as MMap, ACCESS_READ
+from multiprocessing import cpu_count, Pool
+import os
+import re
+from time import sleep
 
 
 BLOCKSIZE = 1024
+FAST_BLOCKSIZE = 1 << 16
+
+ENGINES = ('fast', 'reference')
+
+# <name>, <name:len> or <name:len:type>; '<' may not appear inside a tag, so a
+# stray '<' in comment text never swallows the tag that follows it.
+TAG_RE = re.compile(r'<([^:<>]*)(?::([^:<>]*)(?::([^:<>]*))?)?>')
+EOR_RE = re.compile(r'<eor>', re.IGNORECASE)
+
+NAN = float('nan')
+
+WRITE_BUFSIZE = 1 << 20
+
+# keys Reader adds to records which are not part of the file
+SYNTHETIC_FIELDS = frozenset(['app_datetime_on', 'app_datetime_off'])
+
+FOLLOW_INTERVAL = 1.0
+
+INDEX_SUFFIX = '.idx'
+INDEX_VERSION = 1
+
+# smallest byte range worth handing to a parallel_read worker
+MIN_CHUNK = 1 << 20
+
+
+log = logging.getLogger(__name__)
 
 
 class ParseError(Exception):
@@ -55,27 +90,321 @@ class Field(object):
         return True
 
 
+class Lexer(object):
+    """Slice-based ADIF lexer.
+
+    Iterating yields a Field for each tag found in buf from pos onwards. Tags
+    are located with str.find and TAG_RE and each body is taken as one slice
+    of its declared length, so the cost is linear in the input size however
+    long the bodies are. buf may be any object supporting find, slicing and
+    the buffer protocol, e.g. a str or an mmap.
+
+    If read is given, buf is only the first block of a stream and more data is
+    pulled through read(n) as needed; otherwise buf is taken to be complete.
+
+    After each Field is yielded, offset is the absolute position just past
+    it, counting buf[0] as position base.
+
+    If fields is given, only tags whose lower cased name is in it are
+    yielded; the bodies of all others are skipped by length without being
+    sliced out.
+    """
+
+    def __init__(self, buf, pos=0, read=None, blocksize=FAST_BLOCKSIZE,
+                 base=0, fields=None):
+        self.buf = buf
+        self.fields = fields
+        self.pos = pos
+        self.read = read
+        self.blocksize = blocksize
+        self.base = base
+        self.offset = base + pos
+
+    def __iter__(self):
+        buf, pos, read, blocksize = self.buf, self.pos, self.read, self.blocksize
+        base = self.base
+        fields = self.fields
+        match = TAG_RE.match
+        # raw tag name -> lower cased name, or None if it is to be skipped
+        names = {}
+        eof = read is None or len(buf) < blocksize
+        while True:
+            start = buf.find('<', pos)
+            if start < 0:
+                if eof:
+                    return
+                base += len(buf)
+                buf = read(blocksize)
+                eof = len(buf) < blocksize
+                pos = 0
+                continue
+            mo = match(buf, start)
+            if mo is None:
+                close = buf.find('>', start)
+                stray = buf.find('<', start + 1)
+                if stray >= 0 and (close < 0 or stray < close):
+                    # '<' in comment text
+                    pos = start + 1
+                    continue
+                if close >= 0:
+                    raise ParseError("Malformed tag %r" % buf[start:close + 1])
+                if eof:
+                    return
+                # tag straddles the end of the buffer
+                chunk = read(blocksize)
+                eof = len(chunk) < blocksize
+                base += start
+                buf = buf[start:] + chunk
+                pos = 0
+                continue
+            name, length, type = mo.groups()
+            try:
+                lname = names[name]
+            except KeyError:
+                lname = names[name] = name.lower()
+                if fields is not None and lname not in fields:
+                    lname = names[name] = None
+            if length is None:
+                body = ''
+                pos = mo.end()
+            elif lname is None:
+                try:
+                    length = int(length)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    raise ParseError("Invalid field length %r" % mo.group(0))
+                pos = mo.end() + length
+                if pos > len(buf):
+                    if eof:
+                        return
+                    # skip the rest of the body without keeping it
+                    want = pos - len(buf)
+                    base += len(buf) + want
+                    while want:
+                        chunk = read(min(want, blocksize))
+                        if not chunk:
+                            return
+                        want -= len(chunk)
+                    buf = read(blocksize)
+                    eof = len(buf) < blocksize
+                    pos = 0
+                continue
+            else:
+                try:
+                    length = int(length)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    raise ParseError("Invalid field length %r" % mo.group(0))
+                bodystart = mo.end()
+                pos = bodystart + length
+                if pos > len(buf):
+                    if eof:
+                        return
+                    # body straddles the end of the buffer
+                    want = max(blocksize, pos - len(buf))
+                    chunk = read(want)
+                    eof = len(chunk) < want
+                    base += start
+                    buf = buf[start:] + chunk
+                    pos = 0
+                    continue
+                body = buf[bodystart:pos]
+            if lname is None:
+                continue
+            self.offset = base + pos
+            yield Field(lname, type.lower() if type else '', body)
+
+
 class Reader(object):
-    def __init__(self, flo):
+    def __init__(self, flo, engine='fast', buf=None, encoding=None,
+                 fields=None, where=None):
+        """Read ADIF from file like object flo.
+
+        If buf is given it holds the whole file, e.g. an mmap of flo, and is
+        lexed directly; flo is then only kept so close() can release it and
+        may be None. Each iteration over a buffer backed Reader keeps its own
+        position, so several may run at once.
+
+        The file is lexed as raw bytes and record values are byte strings.
+        encoding is the file's text encoding; TypedRecord views from typed()
+        decode with it, and only the values actually read.
+
+        fields, if given, lists the only fields records will contain; the
+        fast engine skips the bodies of all others unread. where, if given,
+        is called with a plain dict of each record's (selected) fields, and
+        records for which it returns false are dropped before the record
+        itself is built.
+        """
+        if engine not in ENGINES:
+            raise ValueError("Unknown lexer engine %r" % engine)
+        if buf is not None and engine != 'fast':
+            raise ValueError("Buffer input requires the fast engine")
+        self.engine = engine
+        self.encoding = encoding
         self.adif_ver = None
         self.flo = flo
-        # read header
-        flo.seek(0)
-        c = flo.read(1)
-        if c == '<':
-            self.header_present = False
+        self.buf = buf
+        self.fields = None
+        self.where = where
+        self.index = None
+        self.bookmark = 0
+        if buf is not None:
+            self.header_present = buf[:1] != '<'
+            if self.header_present:
+                lexer = Lexer(buf, 1)
+                self._read_header(lexer)
+                self.bookmark = lexer.offset
+        else:
+            # read header
             flo.seek(0)
+            c = flo.read(1)
+            if c == '<':
+                self.header_present = False
+                flo.seek(0)
+            else:
+                self.header_present = True
+                self._read_header(self._lex(blocksize=1))
+            self.bookmark = flo.tell()
+        # where the records start; bookmark moves with seek_record
+        self.data_start = self.bookmark
+        if fields is not None:
+            self.fields = frozenset([f.lower() for f in fields] + ['eor'])
+
+    @classmethod
+    def from_path(cls, path, mmap=True, index=False, **kwargs):
+        """Open the ADIF file at path.
+
+        With mmap the file is memory mapped and lexed in place rather than
+        copied through file buffers. With index, a RecordIndex is loaded
+        from (or built and saved to) a sidecar file; see load_index. Other
+        keyword arguments are passed on to Reader.
+        """
+        flo = open(path, 'rb')
+        if not mmap:
+            self = cls(flo, **kwargs)
+        else:
+            try:
+                buf = MMap(flo.fileno(), 0, access=ACCESS_READ)
+            except ValueError:
+                # empty files can't be mapped
+                buf = ''
+            self = cls(flo, buf=buf, **kwargs)
+        if index:
+            self.load_index(path)
+        return self
+
+    def load_index(self, path=None, sidecar=None):
+        """Attach a RecordIndex for random access by record number.
+
+        path is the file being read, by default flo.name. The index is kept
+        in sidecar, by default path + INDEX_SUFFIX, and is rebuilt and
+        rewritten whenever the file's size or mtime no longer match it.
+        """
+        if path is None:
+            path = self.flo.name
+        if sidecar is None:
+            sidecar = path + INDEX_SUFFIX
+        st = os.stat(path)
+        index = RecordIndex.load(sidecar)
+        if index is None or (index.size, index.mtime) != (
+                st.st_size, st.st_mtime):
+            index = RecordIndex.build(self)
+            index.size, index.mtime = st.st_size, st.st_mtime
+            try:
+                index.save(sidecar)
+            except (IOError, OSError), e:
+                log.warning("Unable to save ADIF index %s: %s", sidecar, e)
+        self.index = index
+        return index
+
+    def seek_record(self, i):
+        """Make the next iteration start at record number i. Only iteration
+        is affected; the index and item access still count from the first
+        record."""
+        self.bookmark = self.index.offsets[i]
+
+    def __getitem__(self, i):
+        """Return record number i, or a list of records for a slice.
+
+        Requires load_index. Field selection applies but where doesn't.
+        """
+        if self.index is None:
+            raise TypeError("Reader has no index; call load_index first")
+        offsets = self.index.offsets
+        count = len(offsets) - 1
+        if isinstance(i, slice):
+            return [self._read_record(offsets[j], offsets[j + 1])
+                    for j in xrange(*i.indices(count))]
+        if i < 0:
+            i += count
+        if not 0 <= i < count:
+            raise IndexError(i)
+        return self._read_record(offsets[i], offsets[i + 1])
+
+    def _read_record(self, start, end):
+        if self.buf is not None:
+            lexer = Lexer(self.buf, start, fields=self.fields)
         else:
-            self.header_present = True
-            for field in self._lex(blocksize=1):
-                if field.name == 'adif_ver':
-                    self.adif_ver = field.body
-                elif field.name == 'eoh':
-                    break
-        self.bookmark = flo.tell()
-
-    def _lex(self, blocksize=BLOCKSIZE):
-        """Given a file like object, yield named tuple for each record."""
+            self.flo.seek(start)
+            lexer = Lexer(self.flo.read(end - start), fields=self.fields)
+        for rec in _records(lexer):
+            return rec
+
+    @classmethod
+    def from_bytes(cls, data, **kwargs):
+        """Read ADIF held in memory as bytes, bytearray or memoryview.
+
+        Nothing is decoded up front. Mutable and view buffers are copied to
+        bytes once, since they can't be searched in place.
+        """
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        elif isinstance(data, bytearray):
+            data = bytes(data)
+        return cls(None, buf=data, **kwargs)
+
+    def close(self):
+        if self.buf is not None and not isinstance(self.buf, basestring):
+            self.buf.close()
+        if self.flo is not None:
+            self.flo.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _read_header(self, fields):
+        for field in fields:
+            if field.name == 'adif_ver':
+                self.adif_ver = field.body
+            elif field.name == 'eoh':
+                break
+
+    def _lex(self, blocksize=None):
+        """Yield a Field for each tag using the selected lexer engine."""
+        if self.engine == 'reference':
+            return self._lex_reference(blocksize or BLOCKSIZE)
+        return self._lex_fast(blocksize or FAST_BLOCKSIZE)
+
+    def _lex_fast(self, blocksize=FAST_BLOCKSIZE):
+        """Yield a Field for each tag from the current position."""
+        if self.buf is not None:
+            return iter(Lexer(self.buf, self.bookmark, fields=self.fields))
+        base = self.flo.tell()
+        read = self.flo.read
+        return iter(Lexer(read(blocksize), 0, read, blocksize, base,
+                          self.fields))
+
+    def _lex_reference(self, blocksize=BLOCKSIZE):
+        """Given a file like object, yield named tuple for each record.
+
+        Original per-character state machine, kept as a reference engine for
+        comparison against _lex_fast.
+        """
         flo = self.flo
         state = 'comment'
         pos = 0
@@ -138,30 +467,654 @@ class Reader(object):
 
     def __iter__(self):
         """Iterate over records in file"""
-        self.flo.seek(self.bookmark)
-        rec = OrderedDict()
-        for field in self._lex():
-            #print field
-            if field.name == 'eor':
-                #print 'yield rec'
-                if 'qso_date' in rec and 'time_on' in rec:
-                    rec['app_datetime_on'] = datetime(int(rec['qso_date'][:4]),
-                                          int(rec['qso_date'][4:6]),
-                                          int(rec['qso_date'][6:8]),
-                                          int(rec['time_on'][:2]),
-                                          int(rec['time_on'][2:4]))
-                if 'qso_date' in rec and 'time_off' in rec:
-                    rec['app_datetime_off'] = datetime(int(rec['qso_date'][:4]),
-                                          int(rec['qso_date'][4:6]),
-                                          int(rec['qso_date'][6:8]),
-                                          int(rec['time_off'][:2]),
-                                          int(rec['time_off'][2:4]))
+        return self._records()
+
+    def _records(self, finish=True):
+        if self.buf is None:
+            self.flo.seek(self.bookmark)
+        fields = self._lex()
+        if self.engine == 'reference' and self.fields is not None:
+            fields = (f for f in fields if f.name in self.fields)
+        if self.where is not None:
+            return _filtered_records(fields, self.where, finish)
+        return _records(fields, finish)
+
+    def follow(self, interval=FOLLOW_INTERVAL):
+        """Yield records as they are appended to the file, like tail -f.
+
+        Records already in the file are yielded first. Then the file is polled
+        every interval seconds and each complete new record is yielded.
+        follow_pos holds the offset just past the last complete <eor> seen,
+        and a record cut off at the end of the file is read again from there
+        once it is complete. If the file shrinks it is assumed to have been
+        rewritten and is followed again from its header.
+        """
+        flo = self.flo
+        if flo is None:
+            raise TypeError("Can't follow a Reader with no file")
+        self.follow_pos = self.bookmark
+        while True:
+            if os.fstat(flo.fileno()).st_size < self.follow_pos:
+                log.warning("%s shrank; following from the start", flo.name)
+                self.follow_pos = Reader(flo).bookmark
+            flo.seek(self.follow_pos)
+            read = flo.read
+            lexer = Lexer(read(FAST_BLOCKSIZE), 0, read, FAST_BLOCKSIZE,
+                          self.follow_pos, self.fields)
+            if self.where is not None:
+                records = _filtered_records(self._track_eor(lexer), self.where)
+            else:
+                records = _records(self._track_eor(lexer))
+            for rec in records:
                 yield rec
-                rec = OrderedDict()
+            sleep(interval)
+
+    def _track_eor(self, lexer):
+        """Pass on lexer's fields, noting the offset after each <eor>."""
+        for field in lexer:
+            if field.name == 'eor':
+                self.follow_pos = lexer.offset
+            yield field
+
+    def typed(self, types=None, encoding=None):
+        """Iterate over records in file as TypedRecord views.
+
+        The raw records don't get app_datetime_on/off; TypedRecord derives
+        them only when they are asked for.
+        """
+        if encoding is None:
+            encoding = self.encoding
+        for rec in self._records(finish=False):
+            yield TypedRecord(rec, types, encoding)
+
+    def table(self):
+        """Read every record into a QsoTable, without building dicts."""
+        table = QsoTable()
+        if self.where is not None or self.engine == 'reference':
+            for rec in self:
+                table.append(rec)
+            return table
+        if self.buf is None:
+            self.flo.seek(self.bookmark)
+        table.extend_fields(self._lex())
+        return table
+
+
+class _Column(object):
+    """Dictionary encoded column: each distinct value is stored once and
+    rows hold an index into values. Code 0 is reserved for missing."""
+    __slots__ = ['values', 'index', 'codes']
+
+    def __init__(self, rows=0):
+        self.values = [None]
+        self.index = {}
+        self.codes = array('I', [0]) * rows
+
+    def set(self, row, value):
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.values)
+            self.values.append(value)
+        codes = self.codes
+        if len(codes) < row:
+            codes.extend(array('I', [0]) * (row - len(codes)))
+        if len(codes) == row:
+            codes.append(code)
+        else:
+            codes[row] = code
+
+    def resize(self, rows):
+        codes = self.codes
+        if len(codes) < rows:
+            codes.extend(array('I', [0]) * (rows - len(codes)))
+        else:
+            del codes[rows:]
+
+
+class QsoRow(Mapping):
+    """Read only view of one QsoTable row; missing fields are absent."""
+    __slots__ = ['table', 'row']
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, name):
+        try:
+            col = self.table.columns[name]
+        except KeyError:
+            raise KeyError(name)
+        value = col.values[col.codes[self.row]]
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __iter__(self):
+        row = self.row
+        for name, col in self.table.columns.iteritems():
+            if col.codes[row]:
+                yield name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return '<QsoRow %d %r>' % (self.row, dict(self))
+
+
+class QsoTable(object):
+    """Columnar store of ADIF records.
+
+    Holds one dictionary encoded column per field name, so a repeated value
+    such as a band, mode or callsign costs a machine integer per row rather
+    than a string object. Rows are QsoRow views made on demand, and whole
+    columns can be fetched at once with column() or floats().
+
+    Only fields from the file are stored; the synthetic app_datetime_on and
+    app_datetime_off keys are not.
+    """
+
+    def __init__(self, records=()):
+        self.columns = OrderedDict()
+        self._len = 0
+        for rec in records:
+            self.append(rec)
+
+    @property
+    def fields(self):
+        return list(self.columns)
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [QsoRow(self, row) for row in xrange(*i.indices(self._len))]
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError(i)
+        return QsoRow(self, i)
+
+    def __iter__(self):
+        for row in xrange(self._len):
+            yield QsoRow(self, row)
+
+    def _column(self, name):
+        col = self.columns.get(name)
+        if col is None:
+            col = self.columns[name] = _Column(self._len)
+        return col
+
+    def append(self, record):
+        """Append a record given as a mapping of field name to body."""
+        row = self._len
+        for name, value in record.iteritems():
+            if name in ('app_datetime_on', 'app_datetime_off'):
+                continue
+            self._column(name).set(row, value)
+        self._len = row + 1
+        for col in self.columns.itervalues():
+            col.resize(self._len)
+
+    def extend_fields(self, fields):
+        """Append records from a stream of Fields, one per <eor>.
+
+        Fields after the last <eor> are discarded, as Reader does.
+        """
+        columns = self.columns
+        row = self._len
+        for field in fields:
+            name = field.name
+            if name == 'eor':
+                row += 1
+                continue
+            col = columns.get(name)
+            if col is None:
+                col = columns[name] = _Column(row)
+            col.set(row, field.body)
+        self._len = row
+        for col in columns.itervalues():
+            col.resize(row)
+
+    def column(self, name):
+        """Return the values of field name for every row, None if missing."""
+        col = self.columns.get(name)
+        if col is None:
+            return [None] * self._len
+        values = col.values
+        return [values[code] for code in col.codes]
+
+    def floats(self, name):
+        """Return field name for every row as an array of doubles.
+
+        Each distinct value is converted once; missing and non-numeric
+        values are NaN.
+        """
+        col = self.columns.get(name)
+        if col is None:
+            return array('d', [NAN]) * self._len
+        converted = []
+        for value in col.values:
+            try:
+                converted.append(float(value))
+            except (TypeError, ValueError):
+                converted.append(NAN)
+        return array('d', [converted[code] for code in col.codes])
+
+
+def to_number(value):
+    return float(value)
+
+
+def to_date(value):
+    """YYYYMMDD"""
+    if len(value) != 8 or not value.isdigit():
+        raise ParseError("Invalid date %r" % value)
+    return date(int(value[:4]), int(value[4:6]), int(value[6:]))
+
+
+def to_time(value):
+    """HHMM or HHMMSS"""
+    if len(value) not in (4, 6) or not value.isdigit():
+        raise ParseError("Invalid time %r" % value)
+    return time(int(value[:2]), int(value[2:4]), int(value[4:6] or 0))
+
+
+_enums = {}
+
+def to_enumeration(value):
+    """Enumerations are case insensitive; normalize to one shared upper case
+    string per distinct value."""
+    value = value.upper()
+    return _enums.setdefault(value, value)
+
+
+def to_location(value):
+    """XDDD MM.MMM, returned as signed decimal degrees."""
+    try:
+        hemi, deg, minutes = value[0].upper(), int(value[1:4]), float(value[5:])
+    except (IndexError, ValueError):
+        raise ParseError("Invalid location %r" % value)
+    if hemi not in 'NSEW' or value[4] != ' ':
+        raise ParseError("Invalid location %r" % value)
+    deg = deg + minutes / 60
+    if hemi in 'SW':
+        return -deg
+    return deg
+
+
+def to_boolean(value):
+    return value.upper() == 'Y'
+
+
+# keyed by the lower case ADIF data type indicator
+CONVERTERS = {
+    'n': to_number,
+    'd': to_date,
+    't': to_time,
+    'e': to_enumeration,
+    'l': to_location,
+    'b': to_boolean,
+}
+
+FIELD_TYPES = dict(
+    [(name, 'n') for name in ('age', 'a_index', 'ant_az', 'ant_el', 'cqz',
+        'distance', 'freq', 'freq_rx', 'ituz', 'k_index', 'max_bursts',
+        'nr_bursts', 'nr_pings', 'rx_pwr', 'sfi', 'srx', 'stx', 'tx_pwr')] +
+    [(name, 'd') for name in ('qso_date', 'qso_date_off', 'qslrdate',
+        'qslsdate', 'lotw_qslrdate', 'lotw_qslsdate', 'eqsl_qslrdate',
+        'eqsl_qslsdate')] +
+    [(name, 't') for name in ('time_on', 'time_off')] +
+    [(name, 'e') for name in ('ant_path', 'arrl_sect', 'band', 'band_rx',
+        'cont', 'eqsl_qsl_rcvd', 'eqsl_qsl_sent', 'lotw_qsl_rcvd',
+        'lotw_qsl_sent', 'mode', 'prop_mode', 'qsl_rcvd', 'qsl_sent',
+        'qsl_rcvd_via', 'qsl_sent_via', 'qso_complete', 'submode')] +
+    [(name, 'l') for name in ('lat', 'lon', 'my_lat', 'my_lon')] +
+    [(name, 'b') for name in ('force_init', 'qso_random', 'swl')])
+
+
+class TypedRecord(Mapping):
+    """View of a record which converts values to Python types.
+
+    raw is any mapping of field name to ADIF body, e.g. a record from Reader
+    or a QsoRow. Each value is converted according to its type in types
+    (FIELD_TYPES by default) the first time it is read and then cached;
+    fields which are never read are never converted. Fields of unknown type
+    are returned unchanged.
+
+    If encoding is given, byte string values are decoded with it before
+    conversion, again only when read.
+
+    app_datetime_on and app_datetime_off are derived from the typed date and
+    time fields when raw doesn't already carry them.
+    """
+    __slots__ = ['raw', 'types', 'encoding', 'cache']
+
+    def __init__(self, raw, types=None, encoding=None):
+        self.raw = raw
+        self.types = FIELD_TYPES if types is None else types
+        self.encoding = encoding
+        self.cache = {}
+
+    def __getitem__(self, name):
+        cache = self.cache
+        try:
+            return cache[name]
+        except KeyError:
+            pass
+        try:
+            value = self.raw[name]
+        except KeyError:
+            if name == 'app_datetime_on':
+                value = self._datetime('time_on')
+            elif name == 'app_datetime_off':
+                value = self._datetime('time_off')
+            else:
+                raise
+        else:
+            if self.encoding is not None and isinstance(value, bytes):
+                value = value.decode(self.encoding)
+            conv = CONVERTERS.get(self.types.get(name))
+            if conv is not None and isinstance(value, basestring):
+                value = conv(value)
+        cache[name] = value
+        return value
+
+    def _datetime(self, timefield):
+        if 'qso_date' not in self.raw or timefield not in self.raw:
+            raise KeyError('app_datetime' + timefield[4:])
+        return datetime.combine(self['qso_date'], self[timefield])
+
+    def __iter__(self):
+        raw = self.raw
+        for name in raw:
+            yield name
+        if 'qso_date' in raw:
+            if 'time_on' in raw and 'app_datetime_on' not in raw:
+                yield 'app_datetime_on'
+            if 'time_off' in raw and 'app_datetime_off' not in raw:
+                yield 'app_datetime_off'
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return '<TypedRecord %r>' % (self.raw,)
+
+
+class RecordIndex(object):
+    """Offsets of the records in an ADIF file, with their call and qso_date.
+
+    offsets has one more entry than there are records: record i spans
+    offsets[i] to offsets[i + 1]. size and mtime are those of the file the
+    index was built from, so a stale index can be detected.
+    """
+
+    def __init__(self, offsets, calls, dates, size=None, mtime=None):
+        self.offsets = offsets
+        self.calls = calls
+        self.dates = dates
+        self.size = size
+        self.mtime = mtime
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def build(cls, reader):
+        """Scan reader's file from its header onwards."""
+        keys = frozenset(['call', 'qso_date', 'eor'])
+        start = reader.data_start
+        if reader.buf is not None:
+            lexer = Lexer(reader.buf, start, fields=keys)
+        else:
+            reader.flo.seek(start)
+            read = reader.flo.read
+            lexer = Lexer(read(FAST_BLOCKSIZE), 0, read, FAST_BLOCKSIZE,
+                          start, keys)
+        offsets = array('L', [start])
+        calls = []
+        dates = []
+        call = date = ''
+        for field in lexer:
+            if field.name == 'eor':
+                offsets.append(lexer.offset)
+                calls.append(call)
+                dates.append(date)
+                call = date = ''
+            elif field.name == 'call':
+                call = field.body
             else:
-                # TODO: type conversion and validation
-                rec[field.name] = field.body
-            #print rec
+                date = field.body
+        return cls(offsets, calls, dates)
+
+    def save(self, path):
+        data = marshal.dumps((INDEX_VERSION, self.size, self.mtime,
+                              self.offsets.tostring(), self.calls, self.dates))
+        with open(path, 'wb') as flo:
+            flo.write(data)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index saved by save, or return None if there is no
+        usable one at path."""
+        try:
+            with open(path, 'rb') as flo:
+                data = marshal.loads(flo.read())
+            version, size, mtime, offsets, calls, dates = data
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if version != INDEX_VERSION:
+            return None
+        offsets = array('L', offsets)
+        return cls(offsets, calls, dates, size, mtime)
+
+
+def _records(fields, finish=True):
+    """Assemble a stream of Fields into records, yielding one per <eor>.
+    finish adds the synthetic keys; see _finish_record."""
+    rec = OrderedDict()
+    for field in fields:
+        #print field
+        if field.name == 'eor':
+            #print 'yield rec'
+            yield _finish_record(rec) if finish else rec
+            rec = OrderedDict()
+        else:
+            # values stay strings; TypedRecord converts on demand
+            rec[field.name] = field.body
+        #print rec
+
+
+def _filtered_records(fields, where, finish=True):
+    """Like _records, but only build records for which where(dict) holds."""
+    pairs = []
+    for field in fields:
+        if field.name == 'eor':
+            if where(dict(pairs)):
+                rec = OrderedDict()
+                for name, body in pairs:
+                    rec[name] = body
+                yield _finish_record(rec) if finish else rec
+            pairs = []
+        else:
+            pairs.append((field.name, field.body))
+
+
+def _finish_record(rec):
+    """Add the synthetic app_datetime_on and app_datetime_off keys."""
+    if 'qso_date' in rec and 'time_on' in rec:
+        rec['app_datetime_on'] = datetime(
+            *_datetime_parts(rec['qso_date'], rec['time_on']))
+    if 'qso_date' in rec and 'time_off' in rec:
+        rec['app_datetime_off'] = datetime(
+            *_datetime_parts(rec['qso_date'], rec['time_off']))
+    return rec
+
+
+def _datetime_parts(qso_date, time):
+    """(year, month, day, hour, minute) of ADIF date and time bodies."""
+    return (int(qso_date[:4]), int(qso_date[4:6]), int(qso_date[6:8]),
+            int(time[:2]), int(time[2:4]))
+
+
+def _chunk_record(pairs):
+    """Marshalable form of a record for parallel_read: (pairs, on, off),
+    on and off being the _datetime_parts of app_datetime_on/off, None if
+    the record has no such time, or False if they couldn't be parsed."""
+    fields = dict(pairs)
+    parts = []
+    for timefield in ('time_on', 'time_off'):
+        if 'qso_date' in fields and timefield in fields:
+            try:
+                parts.append(_datetime_parts(fields['qso_date'],
+                                             fields[timefield]))
+            except ValueError:
+                # left for the parent to raise, as Reader would
+                parts.append(False)
+        else:
+            parts.append(None)
+    return pairs, parts[0], parts[1]
+
+
+def _read_range(buf, start, end):
+    """Parse records from start until one ends at or beyond end.
+
+    Yields (record, offset) pairs, offset being the position just past the
+    record's <eor>.
+    """
+    lexer = Lexer(buf, start)
+    for rec in _records(lexer):
+        yield rec, lexer.offset
+        if lexer.offset >= end:
+            return
+
+
+def _parse_chunk(args):
+    """Process pool worker: lex one byte range of the file at path.
+
+    Returns (start, stop, data); stop is the offset just past the last
+    record, and data is the records in _chunk_record form, marshaled as they
+    are much cheaper to pass back that way than as OrderedDicts. With func,
+    data is instead the pickled list of func(record) for each record. data
+    is None if the range could not be lexed.
+    """
+    path, start, end, func = args
+    records = []
+    pairs = []
+    stop = start
+    with open(path, 'rb') as flo:
+        buf = MMap(flo.fileno(), 0, access=ACCESS_READ)
+        try:
+            lexer = Lexer(buf, start)
+            for field in lexer:
+                if field.name == 'eor':
+                    if func is None:
+                        records.append(_chunk_record(pairs))
+                    else:
+                        rec = OrderedDict()
+                        for name, body in pairs:
+                            rec[name] = body
+                        records.append(func(_finish_record(rec)))
+                    pairs = []
+                    stop = lexer.offset
+                    if stop >= end:
+                        break
+                else:
+                    pairs.append((field.name, field.body))
+        except ParseError:
+            return start, None, None
+        finally:
+            buf.close()
+    if func is not None:
+        return start, stop, cPickle.dumps(records, cPickle.HIGHEST_PROTOCOL)
+    return start, stop, marshal.dumps(records)
+
+
+def _chunk_bounds(buf, start, chunks):
+    """Split buf[start:] into up to chunks ranges ending just after <eor>.
+
+    The <eor> tags are found by a plain search, so one may lie inside a field
+    body; parallel_read detects and repairs such splits.
+    """
+    size = len(buf)
+    step = max((size - start) // chunks, MIN_CHUNK)
+    bounds = []
+    pos = start
+    while pos < size:
+        mo = EOR_RE.search(buf, min(pos + step, size))
+        end = mo.end() if mo is not None else size
+        bounds.append((pos, end))
+        pos = end
+    return bounds
+
+
+def parallel_read(path, workers=None, chunks=None, func=None):
+    """Yield the records of the ADIF file at path, parsing in parallel.
+
+    The file is split at <eor> tags into chunks (by default four per worker)
+    which are parsed by a pool of workers processes, and the records are
+    yielded in file order. Each chunk is checked to start exactly where the
+    previous one stopped; if a split fell inside a field body the chunk is
+    reparsed in this process, so the output is always the same as iterating
+    Reader.from_path(path).
+
+    Workers also parse the dates and times for app_datetime_on/off, but
+    building the OrderedDicts here is still about half the cost of a serial
+    read (3.6s of 7.0s for 200k records), which caps the speedup at about
+    2x however many workers there are.
+
+    To scale further, pass func, a picklable (module level) function of one
+    record: the workers then build the records and apply func to them, and
+    the results of func are yielded instead, in file order. Only those
+    results cross back to this process, so for small results it does
+    little per record work.
+    """
+    if workers is None:
+        workers = cpu_count()
+    with Reader.from_path(path) as reader:
+        buf = reader.buf
+        bounds = []
+        if len(buf):
+            bounds = _chunk_bounds(buf, reader.data_start,
+                                   chunks or workers * 4)
+        if workers < 2 or len(bounds) < 2:
+            for rec in reader:
+                yield rec if func is None else func(rec)
+            return
+        pool = Pool(workers)
+        try:
+            tasks = [(path, start, end, func) for start, end in bounds]
+            pos = reader.data_start
+            for (start, end), (_, stop, data) in zip(
+                    bounds, pool.imap(_parse_chunk, tasks)):
+                if start == pos and data is not None and func is not None:
+                    for result in cPickle.loads(data):
+                        yield result
+                    pos = stop
+                elif start == pos and data is not None:
+                    for pairs, on, off in marshal.loads(data):
+                        rec = OrderedDict()
+                        for name, body in pairs:
+                            rec[name] = body
+                        if on is False or off is False:
+                            _finish_record(rec)
+                        if on:
+                            rec['app_datetime_on'] = datetime(*on)
+                        if off:
+                            rec['app_datetime_off'] = datetime(*off)
+                        yield rec
+                    pos = stop
+                elif pos < end:
+                    # split fell inside a body; resync serially
+                    for rec, pos in _read_range(buf, pos, end):
+                        yield rec if func is None else func(rec)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
 
 def format_header(header_text=' ', adif_ver=None):
     assert header_text != ''
@@ -173,9 +1126,65 @@ def format_header(header_text=' ', adif_ver=None):
 def format_record(record):
     fields = []
     for k,v in record.iteritems():
-        if k == 'app_datetime_on':
+        if k in SYNTHETIC_FIELDS:
             continue
         fields.append("<%s:%d>%s" % (k, len(v), v))
     fields.append('<eor>')
     return ''.join(fields)
 
+
+class Writer(object):
+    """Stream ADIF records to file like object flo.
+
+    The header is written once, on creation. Formatted fields are collected
+    in one reused buffer and handed to flo.write only once bufsize bytes have
+    built up, so large logs go out in a few big writes. Call flush() or close()
+    when done, or use the Writer as a context manager; flo itself is left
+    open.
+    """
+
+    def __init__(self, flo, header_text=' ', adif_ver=None,
+                 bufsize=WRITE_BUFSIZE):
+        self.flo = flo
+        self.bufsize = bufsize
+        self.parts = [format_header(header_text, adif_ver), '\n']
+        self.size = len(self.parts[0]) + 1
+
+    def write(self, record):
+        self.write_many((record,))
+
+    def write_many(self, records):
+        """Write every record in iterable records."""
+        parts, bufsize = self.parts, self.bufsize
+        append = parts.append
+        size = self.size
+        for record in records:
+            for k, v in record.iteritems():
+                if k in SYNTHETIC_FIELDS:
+                    continue
+                field = "<%s:%d>%s" % (k, len(v), v)
+                append(field)
+                size += len(field)
+            append('<eor>\n')
+            size += 6
+            if size >= bufsize:
+                self.flo.write(''.join(parts))
+                del parts[:]
+                size = 0
+        self.size = size
+
+    def flush(self):
+        if self.parts:
+            self.flo.write(''.join(self.parts))
+            del self.parts[:]
+            self.size = 0
+        if hasattr(self.flo, 'flush'):
+            self.flo.flush()
+
+    close = flush
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,490 @@
+#!/usr/bin/env python
+#
+# Copyright 2009, 2012, 2014 by Jeffrey M. Laughlin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Python API for reading Cabrillo contest log files.
+
+Cabrillo version 3.0 is supported. The layout of the QSO: lines differs from
+contest to contest; a Template describes one layout and is chosen by the
+CONTEST: header tag.
+"""
+
+from collections import namedtuple
+from operator import itemgetter
+import re
+
+
+class ParseError(Exception):
+    pass
+
+
+class Template(object):
+    """Layout of the QSO: lines of one contest.
+
+    fields names the whitespace separated tokens following "QSO:". A line
+    with fewer tokens is padded with None, which covers the optional
+    transmitter ID at the end. Lines are returned as instances of record, a
+    namedtuple class made from fields.
+    """
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = tuple(fields)
+        self.record = namedtuple('Qso', self.fields)
+        self.split = self._compile()
+        self.format = self._compile_format()
+
+    def __repr__(self):
+        return '<Template %s>' % self.name
+
+    def _compile_format(self):
+        """Build the function that turns a record back into a QSO: line.
+
+        Fields are padded to the widths used in the Cabrillo specification's
+        examples, per FIELD_WIDTHS, and None values are left blank.
+        """
+        fmt = 'QSO: ' + ' '.join(['%%%ds' % _width(f) for f in self.fields])
+        def format(qso):
+            return (fmt % tuple(['' if v is None else v for v in qso])
+                    ).rstrip() + '\n'
+        return format
+
+    def _compile(self):
+        """Build the function that turns one QSO: line into a record."""
+        n = len(self.fields)
+        pad = [None] * n
+        make = tuple.__new__
+        record = self.record
+        def split(line):
+            tokens = line.split()
+            del tokens[0]
+            if len(tokens) != n:
+                tokens = (tokens + pad)[:n]
+            return make(record, tokens)
+        return split
+
+
+class GenericTemplate(Template):
+    """Fallback for contests without a template.
+
+    The call received is taken to be the token midway between the sending
+    call and the end of the line, after setting aside any odd token out as
+    the transmitter ID. Exchanges are returned as single space separated
+    strings.
+    """
+
+    def __init__(self):
+        Template.__init__(self, 'GENERIC',
+            ['freq', 'mode', 'date', 'time', 'from_call', 'sent_ex', 'call',
+             'rcvd_ex', 'transmitter'])
+
+    def _compile(self):
+        make = tuple.__new__
+        record = self.record
+        def split(line):
+            tokens = line.split()
+            head = tokens[1:6]
+            # sent exchange, call and received exchange, the exchanges being
+            # the same length, then maybe a transmitter ID
+            rest = tokens[6:]
+            transmitter = None
+            if rest and len(rest) % 2 == 0:
+                transmitter = rest.pop()
+            if len(head) < 5 or not rest:
+                raise ParseError("Short QSO line %r" % line)
+            half = len(rest) // 2
+            head.extend((' '.join(rest[:half]), rest[half],
+                         ' '.join(rest[half + 1:]), transmitter))
+            return make(record, head)
+        return split
+
+
+class ColumnTemplate(Template):
+    """Layout with each field at fixed character columns.
+
+    columns gives the (start, end) slice of the line for each field, as laid
+    out in the Cabrillo specification's QSO: line templates. Slicing is done
+    in one itemgetter call; values are stripped and empty ones become None.
+    """
+
+    def __init__(self, name, fields, columns):
+        self.columns = tuple(columns)
+        Template.__init__(self, name, fields)
+
+    def _compile_format(self):
+        # columns count from the start of the line, so lay out the fields
+        # from column 0 and put "QSO:" over the first four blanks
+        parts = []
+        pos = 0
+        for start, end in self.columns:
+            parts.append(' ' * (start - pos) + '%%-%ds' % (end - start))
+            pos = end
+        fmt = ''.join(parts)
+        def format(qso):
+            values = tuple(['' if v is None else v for v in qso])
+            return ('QSO:' + (fmt % values)[4:]).rstrip() + '\n'
+        return format
+
+    def _compile(self):
+        getter = itemgetter(*[slice(start, end) for start, end in self.columns])
+        make = tuple.__new__
+        record = self.record
+        def split(line):
+            return make(record, [v.strip() or None for v in getter(line)])
+        return split
+
+
+class PatternTemplate(Template):
+    """Layout given as a regular expression with a named group per field,
+    for exchanges with optional or variable parts."""
+
+    def __init__(self, name, pattern):
+        self.pattern = re.compile(pattern)
+        fields = sorted(self.pattern.groupindex,
+                        key=self.pattern.groupindex.get)
+        Template.__init__(self, name, fields)
+
+    def _compile(self):
+        match = self.pattern.match
+        make = tuple.__new__
+        record = self.record
+        def split(line):
+            mo = match(line)
+            if mo is None:
+                raise ParseError("QSO line doesn't fit %s: %r"
+                                 % (self.name, line))
+            return make(record, mo.groups())
+        return split
+
+
+# padding for QSO: line fields when writing; negative is left aligned
+FIELD_WIDTHS = {
+    'freq': 5, 'mode': -2, 'date': -10, 'time': -4, 'from_call': -13,
+    'call': -13, 'rst': -3, 'transmitter': -1,
+}
+
+
+WRITE_BUFSIZE = 1 << 20
+
+
+def _width(field):
+    return FIELD_WIDTHS.get(field, FIELD_WIDTHS.get(field[5:], -6))
+
+
+def _fields(*exch):
+    """Field names for a QSO: line whose exchanges have the given parts."""
+    return (['freq', 'mode', 'date', 'time', 'from_call'] +
+            ['sent_' + e for e in exch] + ['call'] +
+            ['rcvd_' + e for e in exch] + ['transmitter'])
+
+
+GENERIC = GenericTemplate()
+
+# keyed by CONTEST: tag or a leading part of it; see get_template
+TEMPLATES = {}
+
+_template_cache = {}
+
+
+def register_template(template, *contests):
+    """Use template for logs whose CONTEST: tag is, or starts with one of
+    contests followed by '-'."""
+    for contest in contests:
+        TEMPLATES[contest.upper()] = template
+    _template_cache.clear()
+
+
+def get_template(contest):
+    """Return the Template for a CONTEST: tag value.
+
+    An exact match is preferred; otherwise trailing '-' separated parts are
+    dropped until a registered name matches, so that "NAQP" covers
+    "NAQP-CW" and "NAQP-SSB". Results are cached.
+    """
+    try:
+        return _template_cache[contest]
+    except KeyError:
+        pass
+    name = (contest or '').strip().upper()
+    template = GENERIC
+    while name:
+        if name in TEMPLATES:
+            template = TEMPLATES[name]
+            break
+        name = name.rpartition('-')[0]
+    _template_cache[contest] = template
+    return template
+
+
+register_template(Template('ARRL-10', _fields('rst', 'ex')), 'ARRL-10')
+register_template(Template('ARRL-DX', _fields('rst', 'ex')), 'ARRL-DX')
+register_template(Template('CQ-WW', _fields('rst', 'zone')), 'CQ-WW')
+register_template(Template('ARRL-SS', _fields('nr', 'prec', 'ck', 'sec')),
+                  'ARRL-SS')
+register_template(Template('NAQP', _fields('name', 'loc')), 'NAQP')
+register_template(Template('ARRL-FD', _fields('class', 'sec')), 'ARRL-FD')
+# W/VE stations add their state or province to the zone
+register_template(PatternTemplate('CQ-WW-RTTY',
+    r'QSO:\s+(?P<freq>\S+)\s+(?P<mode>\S+)\s+(?P<date>\S+)\s+(?P<time>\S+)'
+    r'\s+(?P<from_call>\S+)\s+(?P<sent_rst>\S+)\s+(?P<sent_zone>\d+)'
+    r'(?:\s+(?P<sent_qth>[A-Za-z]+))?\s+(?P<call>\S+)\s+(?P<rcvd_rst>\S+)'
+    r'\s+(?P<rcvd_zone>\d+)(?:\s+(?P<rcvd_qth>[A-Za-z]+))?'
+    r'(?:\s+(?P<transmitter>\d))?\s*$'), 'CQ-WW-RTTY')
+
+
+class Reader(object):
+    """Read a Cabrillo log from file like object flo.
+
+    The header is read when the Reader is created; its tags are in header,
+    repeated tags such as ADDRESS or SOAPBOX being joined with newlines.
+    Iterating yields a record for each QSO: line, using template or else
+    the one registered for the log's CONTEST: tag.
+    """
+
+    def __init__(self, flo, template=None):
+        self.flo = flo
+        self.header = {}
+        flo.seek(0)
+        while True:
+            pos = flo.tell()
+            line = flo.readline()
+            if not line or line.startswith('QSO:'):
+                break
+            tag, sep, value = line.partition(':')
+            if not sep:
+                continue
+            tag, value = tag.strip().upper(), value.strip()
+            if tag in self.header:
+                self.header[tag] += '\n' + value
+            else:
+                self.header[tag] = value
+        self.bookmark = pos
+        self.callsign = self.header.get('CALLSIGN')
+        self.contest = self.header.get('CONTEST')
+        if template is None:
+            template = get_template(self.contest)
+        self.template = template
+
+    def __iter__(self):
+        """Iterate over QSO records in file"""
+        self.flo.seek(self.bookmark)
+        split = self.template.split
+        for line in self.flo:
+            if line.startswith('QSO:'):
+                yield split(line)
+            elif line.startswith('END-OF-LOG'):
+                break
+
+
+class Writer(object):
+    """Stream a Cabrillo log to file like object flo.
+
+    header is a sequence of (tag, value) pairs, or a mapping, written after
+    START-OF-LOG when the Writer is created; a tag may be repeated. QSO:
+    lines are laid out by template, by default the one for the CONTEST: tag.
+    Lines are collected in one reused buffer and written once bufsize bytes
+    have built up. close() writes END-OF-LOG and flushes; flo is left open.
+    """
+
+    def __init__(self, flo, header=(), template=None, bufsize=WRITE_BUFSIZE):
+        if hasattr(header, 'items'):
+            header = header.items()
+        self.flo = flo
+        self.bufsize = bufsize
+        self.contest = None
+        self.callsign = None
+        lines = ['START-OF-LOG: 3.0\n']
+        for tag, value in header:
+            tag = tag.upper()
+            if tag == 'CONTEST':
+                self.contest = value
+            elif tag == 'CALLSIGN':
+                self.callsign = value
+            for line in str(value).split('\n'):
+                lines.append('%s: %s\n' % (tag, line))
+        if template is None:
+            template = get_template(self.contest)
+        self.template = template
+        self.parts = lines
+        self.size = sum(len(l) for l in lines)
+
+    def write(self, qso):
+        self.write_many((qso,))
+
+    def write_many(self, qsos):
+        """Write every QSO in iterable qsos.
+
+        A QSO is a record of the template or a mapping of its field names.
+        """
+        parts, bufsize = self.parts, self.bufsize
+        append = parts.append
+        fields = self.template.fields
+        format = self.template.format
+        size = self.size
+        for qso in qsos:
+            if not isinstance(qso, tuple):
+                qso = [qso.get(f) for f in fields]
+            line = format(qso)
+            append(line)
+            size += len(line)
+            if size >= bufsize:
+                self.flo.write(''.join(parts))
+                del parts[:]
+                size = 0
+        self.size = size
+
+    def flush(self):
+        if self.parts:
+            self.flo.write(''.join(self.parts))
+            del self.parts[:]
+            self.size = 0
+        if hasattr(self.flo, 'flush'):
+            self.flo.flush()
+
+    def close(self):
+        self.parts.append('END-OF-LOG:\n')
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Cabrillo field -> ADIF fields to take its value from, in order of preference
+ADIF_FIELDS = {
+    'from_call': ('station_callsign', 'operator'),
+    'call': ('call',),
+    'sent_rst': ('rst_sent',),
+    'rcvd_rst': ('rst_rcvd',),
+    'sent_ex': ('stx_string', 'stx'),
+    'rcvd_ex': ('srx_string', 'srx'),
+    'sent_nr': ('stx',),
+    'rcvd_nr': ('srx',),
+    'sent_zone': ('my_cq_zone',),
+    'rcvd_zone': ('cqz',),
+    'sent_qth': ('my_state',),
+    'rcvd_qth': ('state', 've_prov'),
+    'sent_name': ('my_name',),
+    'rcvd_name': ('name',),
+    'sent_loc': ('my_state',),
+    'rcvd_loc': ('state', 've_prov'),
+    'sent_sec': ('my_arrl_sect',),
+    'rcvd_sec': ('arrl_sect',),
+    'rcvd_prec': ('precedence',),
+    'rcvd_ck': ('check',),
+    'rcvd_class': ('class',),
+}
+
+ADIF_MODES = {
+    'CW': 'CW', 'SSB': 'PH', 'USB': 'PH', 'LSB': 'PH', 'AM': 'PH', 'FM': 'FM',
+    'RTTY': 'RY',
+}
+
+# lower edge in MHz of the bands Cabrillo names rather than giving in kHz
+VHF_BANDS = [
+    (50, '50'), (70, '70'), (144, '144'), (222, '222'), (420, '432'),
+    (902, '902'), (1240, '1.2G'), (2300, '2.3G'), (3300, '3.4G'),
+    (5650, '5.7G'), (10000, '10G'), (24000, '24G'), (47000, '47G'),
+    (75500, '75G'), (119980, '122G'), (134000, '134G'), (241000, '241G'),
+]
+
+
+def adif_freq(freq):
+    """Cabrillo frequency for an ADIF freq in MHz: kHz below 30 MHz, else the
+    band."""
+    mhz = float(freq)
+    if mhz < 30:
+        return str(int(round(mhz * 1000)))
+    band = VHF_BANDS[0][1]
+    for edge, name in VHF_BANDS:
+        if mhz < edge:
+            break
+        band = name
+    return band
+
+
+def _adif_mode(rec):
+    mode = rec.get('mode', '').upper()
+    if mode:
+        return ADIF_MODES.get(mode, 'DG')
+
+
+def _adif_date(rec):
+    date = rec.get('qso_date')
+    if date:
+        return '-'.join((date[:4], date[4:6], date[6:8]))
+
+
+def _adif_time(rec):
+    return rec.get('time_on', '')[:4] or None
+
+
+# Cabrillo fields which are computed from ADIF records rather than copied
+ADIF_CONVERSIONS = {
+    'freq': lambda rec: adif_freq(rec['freq']) if rec.get('freq') else None,
+    'mode': _adif_mode,
+    'date': _adif_date,
+    'time': _adif_time,
+}
+
+
+def _adif_getter(field, default):
+    conv = ADIF_CONVERSIONS.get(field)
+    if conv is not None:
+        return lambda rec: conv(rec) or default
+    names = ADIF_FIELDS.get(field, ())
+    def get(rec):
+        for name in names:
+            value = rec.get(name)
+            if value:
+                return value
+        return default
+    return get
+
+
+def from_adif(template, defaults=None):
+    """Return a function converting ADIF records to template records.
+
+    defaults gives values for fields an ADIF record has no value for,
+    typically parts of the sent exchange or from_call.
+    """
+    defaults = defaults or {}
+    getters = [_adif_getter(f, defaults.get(f)) for f in template.fields]
+    make = tuple.__new__
+    record = template.record
+    def convert(rec):
+        return make(record, [get(rec) for get in getters])
+    return convert
+
+
+def adif_to_cabrillo(records, flo, header=(), template=None, defaults=None):
+    """Write ADIF records to flo as a Cabrillo log.
+
+    records is any iterable of ADIF record mappings, such as an adif.Reader;
+    it is consumed one record at a time so memory use doesn't grow with the
+    log. header and template are as for Writer and defaults as for
+    from_adif; from_call defaults to the CALLSIGN: tag.
+    """
+    with Writer(flo, header, template) as writer:
+        defaults = dict(defaults or ())
+        if writer.callsign:
+            defaults.setdefault('from_call', writer.callsign)
+        convert = from_adif(writer.template, defaults)
+        writer.write_many(convert(rec) for rec in records)
@@ -23,76 +23,740 @@ Ported from yfklog
 Alpha quality, largely untested; please help!
 """
 
-from collections import defaultdict
+from array import array
+from bisect import bisect_right
+from collections import defaultdict, namedtuple, OrderedDict
+from cStringIO import StringIO
+import csv
+from datetime import datetime
+import hashlib
+import logging
+import marshal
+import os
 import re
+import threading
+import time
+from xml.etree import cElementTree
 
 import pdb
 
+log = logging.getLogger(__name__)
+
 
 class InvalidDxcc(Exception): pass
 class InvalidCallsign(Exception): pass
 
 
+class Dxcc(namedtuple('Dxcc', 'name cq itu cont lat lon utcoff prefix')):
+    """Immutable DXCC entity record, as returned by CtyDat.getdxcc.
+
+    Fields are strings straight from cty.dat and can be read as attributes
+    or, like the dicts this used to be, as dxcc['cq']; in, get and keys
+    work on field names too. Iterating still yields the values, as for
+    any tuple.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            if key not in self._keys:
+                raise KeyError(key)
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def get(self, key, default=None):
+        if key in self._keys:
+            return getattr(self, key)
+        return default
+
+    def keys(self):
+        return list(self._fields)
+
+Dxcc._keys = frozenset(Dxcc._fields)
+
+
+# cty.dat marks some WAE-only entities with a *; lookups report the DXCC
+STAR_PREFIXES = {
+    '*TA1': 'TA',  # Turkey
+    '*4U1V': 'OE',  # 4U1VIC is in OE..
+    '*GM/s': 'GM',  # Shetlands
+    '*IG9': 'I',  # African Italy
+    '*IT9': 'I',  # Sicily
+    '*JW/b': 'JW',  # Bear Island
+}
+
+
+# fields returned by CtyDat.getdxcc_many(columns=True); lat/lon are floats
+DXCC_COLUMNS = ('prefix', 'name', 'cq', 'itu', 'cont', 'lat', 'lon')
+NAN = float('nan')
+
+# sidecar of a cty.dat holding its compiled indexes; see CtyDat.compile
+COMPILED_SUFFIX = '.compiled'
+COMPILED_VERSION = 2
+# where CtyDat.from_path keeps snapshots it can't save next to the file
+COMPILED_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.environ['HOME']), '.ctydat_cache')
+
+# Club Log start/end dates, less their always UTC zone
+XML_TIME = '%Y-%m-%dT%H:%M:%S'
+
+# longest prefix held in the table built by CtyDat.build_dense
+DENSE_DEPTH = 4
+# marks dense table prefixes that longer aliases extend
+_DEEP = object()
+
+# seconds between CtyDatManager checks for an updated cty.dat
+RELOAD_INTERVAL = 60.0
+
+# number of calls whose getwpx/getdxcc results are remembered
+CACHE_SIZE = 8192
+
+LID_ADDITIONS = ('QRP', 'LGT')
+
+SLASH_RE = re.compile(r'/+')
+FULLCALL_RE = re.compile(r'^[A-Z0-9]*\d[A-Z]+$')
+AREA_RE = re.compile(r'(.+\d)[A-Z]*')
+SHORT_AREA_RE = re.compile(r'^([A-Z]\d)\d$')
+AREA_LETTERS_RE = re.compile(r'(.*[A-Z])\d+')
+PORTABLE_RE = re.compile(r'(^P$)|(^M{1,2}$)|(^AM$)|(^A$)')
+NUMBER_RE = re.compile(r'^\d\d+$')
+OH_RE = re.compile(r'(^OH/)|(/OH[1-9]?$)')
+ROTUMA_RE = re.compile(r'(^3D2R)|(^3D2.+/R)')
+CONWAY_RE = re.compile(r'^3D2C')
+# AD1C files list a =VERyyyymmdd pseudo call giving their release
+VERSION_RE = re.compile(r'^VER(\d{8})$')
+
+
+# alias prefix, then optional overrides: (cq) [itu] <lat/lon> {cont} ~utcoff~
+ALIAS_RE = re.compile(r'=?([^(\[<{~]+)(.*)')
+OVERRIDE_RES = [
+    ('cq', re.compile(r'\((\d+)\)')),
+    ('itu', re.compile(r'\[(\d+)\]')),
+    ('lat', re.compile(r'<([-+\d.]+)/')),
+    ('lon', re.compile(r'/([-+\d.]+)>')),
+    ('cont', re.compile(r'\{(\w+)\}')),
+    ('utcoff', re.compile(r'~([-+\d.]+)~')),
+]
+
+
+def parse_alias(alias):
+    """Split a cty.dat prefix or =call alias into (prefix, overrides), the
+    overrides being a dict of the fields it sets."""
+    mo = ALIAS_RE.match(alias)
+    prefix, rest = mo.group(1), mo.group(2)
+    overrides = {}
+    if rest:
+        for field, regex in OVERRIDE_RES:
+            mo = regex.search(rest)
+            if mo is not None:
+                overrides[field] = mo.group(1)
+        # zones are padded like the entity zones they replace
+        for field in ('cq', 'itu'):
+            if field in overrides:
+                overrides[field] = overrides[field].zfill(2)
+    return prefix, overrides
+
+
+def split_call(call):
+    """Decompose a callsign into (prefix, base, suffix) around its slashes,
+    e.g. 'SW8/SW1KYQ//P' -> ('SW8', 'SW1KYQ', 'P'); missing parts are None.
+
+    As in yfklog, /QRP and /LGT are dropped, a second part shorter than
+    three characters is a suffix, and a full call followed by a prefix
+    (DJ1YFK/KH6) is taken as operating from that prefix.
+    """
+    fields = [f for f in SLASH_RE.split(call) if f]
+    if fields and fields[-1] in LID_ADDITIONS:
+        fields.pop()
+    if len(fields) == 1:
+        return None, fields[0], None
+    elif len(fields) == 2:
+        a, b = fields
+        if len(b) < 3 or (FULLCALL_RE.match(a) is not None and
+                           FULLCALL_RE.match(b) is None):
+            return None, a, b
+        return a, b, None
+    elif len(fields) == 3:
+        return tuple(fields)
+    raise InvalidCallsign(call)
+
+
+class _LruCache(object):
+    """Bounded dict which forgets the least recently used key. Safe to
+    share between threads."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+def format_alias(prefix, overrides):
+    """Inverse of parse_alias: write prefix and its overrides in cty.dat
+    syntax."""
+    alias = [prefix]
+    if 'cq' in overrides:
+        alias.append('(%s)' % overrides['cq'])
+    if 'itu' in overrides:
+        alias.append('[%s]' % overrides['itu'])
+    if 'lat' in overrides:
+        alias.append('<%s/%s>' % (overrides['lat'], overrides['lon']))
+    if 'cont' in overrides:
+        alias.append('{%s}' % overrides['cont'])
+    if 'utcoff' in overrides:
+        alias.append('~%s~' % overrides['utcoff'])
+    return ''.join(alias)
+
+
+def _xml_records(flo):
+    """Yield (kind, fields) for the entity, prefix and exception elements
+    of a Club Log cty.xml, fields mapping child tag to text."""
+    for event, elem in cElementTree.iterparse(flo):
+        kind = elem.tag.rsplit('}', 1)[-1]
+        # records have child elements; their prefix and entity children
+        # are plain text
+        if kind not in ('entity', 'prefix', 'exception') or not len(elem):
+            continue
+        fields = dict((child.tag.rsplit('}', 1)[-1], child.text or '')
+                      for child in elem)
+        elem.clear()
+        yield kind, fields
+
+
+def _xml_interval(fields):
+    """[start, end) datetimes of a Club Log record, unbounded if absent."""
+    start, end = fields.get('start'), fields.get('end')
+    return (datetime.strptime(start[:19], XML_TIME) if start else datetime.min,
+            datetime.strptime(end[:19], XML_TIME) if end else datetime.max)
+
+
+def _xml_dxcc(fields):
+    """Dxcc for Club Log fields. Longitudes there are positive east, so
+    they are negated to cty.dat's positive west; there is no ITU zone or
+    UTC offset."""
+    return Dxcc(intern(fields['name']), intern(fields['cqz'].zfill(2)), '',
+                intern(fields['cont']), intern(fields['lat']),
+                intern('%.2f' % -float(fields['long'])), '',
+                intern(fields['prefix']))
+
+
+class _Intervals(object):
+    """Records of one call or alias over time, in non-overlapping
+    [start, end) intervals sorted by start."""
+    __slots__ = ['starts', 'ends', 'records']
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.records = []
+
+    def add(self, start, end, record):
+        i = bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+        self.records.insert(i, record)
+
+    def at(self, when):
+        """The record valid at when, or None."""
+        i = bisect_right(self.starts, when) - 1
+        if i >= 0 and when < self.ends[i]:
+            return self.records[i]
+
+
+class History(object):
+    """Interval index of cty.dat aliases over time, used by
+    CtyDat.getdxcc(call, when).
+
+    exact maps full calls, and trie (shaped like CtyDat.trie) prefixes, to
+    the Dxcc records they resolved to in each interval.
+    """
+
+    def __init__(self):
+        self.exact = {}
+        self.trie = {}
+
+    def add(self, alias, start, end, record):
+        """Record that alias, a prefix or =call, meant record from start
+        until end."""
+        if alias.startswith('='):
+            intervals = self.exact.setdefault(alias[1:], _Intervals())
+        else:
+            node = self.trie
+            for c in alias:
+                node = node.setdefault(c, {})
+            intervals = node.setdefault('', _Intervals())
+        intervals.add(start, end, record)
+
+    def add_ctydat(self, ctydat, start, end):
+        """Add all of ctydat's aliases as valid from start until end."""
+        for call, entry in ctydat.exact.iteritems():
+            self.add('=' + call, start, end, ctydat.records[entry])
+        for mainprefix, aliases in ctydat.prefixes.iteritems():
+            for alias in aliases:
+                prefix, overrides = parse_alias(alias)
+                record = ctydat.records[_entry(mainprefix, overrides)]
+                self.add(prefix, start, end, record)
+
+    def match(self, call, when):
+        """The record of the longest prefix of call valid at when, or
+        None."""
+        node = self.trie
+        best = None
+        for c in call:
+            node = node.get(c)
+            if node is None:
+                break
+            intervals = node.get('')
+            if intervals is not None:
+                best = intervals.at(when) or best
+        return best
+
+
+def _cache_path(path):
+    """Snapshot for the country file at path in COMPILED_CACHE_DIR."""
+    path = os.path.abspath(path)
+    return os.path.join(COMPILED_CACHE_DIR, '%s-%s%s' % (
+        hashlib.sha1(path).hexdigest()[:12], os.path.basename(path),
+        COMPILED_SUFFIX))
+
+
+def _entry(mainprefix, overrides):
+    """Index entry for an alias: (mainprefix, sorted override items)."""
+    return mainprefix, tuple(sorted(overrides.iteritems()))
+
+
 class CtyDat(object):
-    fields = ['name', 'cq', 'itu', 'cont', 'lat', 'lon', 'utcoff', 'prefix']
+    fields = list(Dxcc._fields)
 
-    def __init__(self, infile):
-        self.prefixes = defaultdict(list)
-        self.dxcc = {}
+    def __init__(self, infile, cachesize=CACHE_SIZE):
+        self._init_caches(cachesize)
+        self._init_tables()
         for line in infile:
             if line[0] != ' ':
                 # DXCC line
                 line=line.strip()
-                fields = [f.strip() for f in line.split(':')]
-                dxcc = dict(zip(self.fields, fields))
-                mainprefix = dxcc['prefix']
+                fields = [intern(f.strip()) for f in line.split(':')]
+                dxcc = Dxcc._make(fields[:len(self.fields)])
+                mainprefix = dxcc.prefix
                 self.dxcc[mainprefix] = dxcc
             else:
                 line=line.strip()
                 line = line.rstrip(';')
                 line = line.rstrip(',')
-                prefixes = line.split(',')
-                self.prefixes[mainprefix].extend(prefixes)
+                for alias in line.split(','):
+                    if alias.startswith('='):
+                        call, overrides = parse_alias(alias)
+                        self.exact[call] = _entry(mainprefix, overrides)
+                    elif alias:
+                        self.prefixes[mainprefix].append(alias)
+        self._build_indexes()
 
-    def getwpx(self, call):
-        prefix = None
-        a, b, c = None, None, None
-        fields = re.split('/+', call)
+    @classmethod
+    def from_csv(cls, infile, cachesize=CACHE_SIZE):
+        """Load AD1C's cty.csv, with a line per entity of primary prefix,
+        name, DXCC number, continent, CQ zone, ITU zone, latitude,
+        longitude, UTC offset and the space separated aliases."""
+        self = cls.__new__(cls)
+        self._init_caches(cachesize)
+        self._init_tables()
+        for row in csv.reader(infile):
+            if not row:
+                continue
+            mainprefix, name, _, cont, cq, itu, lat, lon, utcoff = map(
+                intern, row[:9])
+            self.dxcc[mainprefix] = Dxcc(name, intern(cq.zfill(2)),
+                                         intern(itu.zfill(2)), cont, lat,
+                                         lon, utcoff, mainprefix)
+            for alias in row[9].rstrip(';').split():
+                if alias.startswith('='):
+                    call, overrides = parse_alias(alias)
+                    self.exact[call] = _entry(mainprefix, overrides)
+                else:
+                    self.prefixes[mainprefix].append(alias)
+        self._build_indexes()
+        return self
+
+    @classmethod
+    def from_xml(cls, infile, cachesize=CACHE_SIZE, now=None, history=False):
+        """Load Club Log's cty.xml, keeping the entities, prefixes and
+        exception calls valid at now (by default the current time).
+
+        Where a prefix or exception call's zone, continent or coordinates
+        differ from its entity's, they become overrides as they would be in
+        cty.dat. Deleted entities are left out. With history, every prefix
+        and exception call also goes into a History with its start and end
+        dates, including those of deleted entities, for getdxcc(call, when).
+        """
+        if now is None:
+            now = datetime.utcnow()
+        self = cls.__new__(cls)
+        self._init_caches(cachesize)
+        self._init_tables()
+        if history:
+            self.history = History()
+        entities = {}
+        lifetimes = {}
+        aliases = []
+        for kind, fields in _xml_records(infile):
+            if kind == 'entity':
+                dxcc = entities[fields['adif']] = _xml_dxcc(fields)
+                lifetimes[fields['adif']] = _xml_interval(fields)
+                if fields.get('deleted') != 'true':
+                    self.dxcc[dxcc.prefix] = dxcc
+            else:
+                aliases.append((kind, fields))
+        for kind, fields in aliases:
+            entity = entities.get(fields.get('adif'))
+            if entity is None:
+                continue
+            # an alias can't outlive its entity
+            start, end = _xml_interval(fields)
+            born, died = lifetimes[fields['adif']]
+            start, end = max(start, born), min(end, died)
+            if start >= end:
+                continue
+            current = (start <= now < end and
+                       self.dxcc.get(entity.prefix) is entity)
+            if not (current or history):
+                continue
+            dxcc = _xml_dxcc(dict(fields, name=entity.name,
+                                  prefix=entity.prefix))
+            overrides = dict((f, getattr(dxcc, f))
+                             for f in ('cq', 'cont', 'lat', 'lon')
+                             if getattr(dxcc, f) != getattr(entity, f))
+            if 'lat' in overrides or 'lon' in overrides:
+                overrides['lat'], overrides['lon'] = dxcc.lat, dxcc.lon
+            call = intern(fields['call'])
+            if history:
+                alias = '=' + call if kind == 'exception' else call
+                self.history.add(alias, start, end,
+                                 entity._replace(**overrides))
+            if not current:
+                continue
+            if kind == 'exception':
+                self.exact[call] = _entry(entity.prefix, overrides)
+            else:
+                self.prefixes[entity.prefix].append(
+                    format_alias(call, overrides))
+        self._build_indexes()
+        return self
+
+    @classmethod
+    def from_eras(cls, eras):
+        """Combine CtyDats from several dated country files for
+        getdxcc(call, when).
+
+        eras is a sequence of (datetime, CtyDat) pairs, each file taken to
+        be valid from its datetime until the next one's. Returns the latest
+        CtyDat, with a History of them all.
+        """
+        eras = sorted(eras, key=lambda era: era[0])
+        if not eras:
+            raise ValueError("No country files")
+        history = History()
+        ends = [start for start, _ in eras[1:]] + [datetime.max]
+        for (start, ctydat), end in zip(eras, ends):
+            history.add_ctydat(ctydat, start, end)
+        latest = eras[-1][1]
+        latest.history = history
+        return latest
+
+    @classmethod
+    def from_data(cls, path, data, cachesize=CACHE_SIZE):
+        """Load the contents data of the country file at path, choosing the
+        format from its extension: .csv, .xml or else cty.dat."""
+        ext = os.path.splitext(path)[1].lower()
+        if ext == '.csv':
+            return cls.from_csv(StringIO(data), cachesize)
+        elif ext == '.xml':
+            return cls.from_xml(StringIO(data), cachesize)
+        return cls(data.splitlines(True), cachesize)
+
+    def _init_tables(self):
+        self.prefixes = defaultdict(list)
+        # full call -> index entry, from =CALL aliases
+        self.exact = {}
+        self.dxcc = {}
+
+    def _build_indexes(self):
+        self.trie = self._build_trie()
+        self.records = self._build_records()
+
+    def _init_caches(self, cachesize):
+        self._wpx_cache = _LruCache(cachesize)
+        self._dxcc_cache = _LruCache(cachesize)
+        self.dense = None
+        self.history = None
+
+    @classmethod
+    def from_path(cls, path, compiled=None, cachesize=CACHE_SIZE):
+        """Load the country file at path through a compiled snapshot, which
+        is (re)written whenever it is missing or doesn't match the file.
+
+        The snapshot is compiled, by default the path + COMPILED_SUFFIX
+        sidecar or, where that can't be written (as for the cty.dat
+        installed with hamtools), a file in COMPILED_CACHE_DIR.
+        """
+        if compiled is None:
+            compiled = [path + COMPILED_SUFFIX, _cache_path(path)]
+        else:
+            compiled = [compiled]
+        for dst in compiled:
+            self = cls.load_compiled(dst, path, cachesize)
+            if self is not None:
+                return self
+        self, source = cls._parse(path, cachesize)
+        for dst in compiled:
+            try:
+                self._save(dst, source)
+                break
+            except (IOError, OSError), e:
+                log.debug("Unable to save compiled %s to %s: %s",
+                          path, dst, e)
+        else:
+            log.warning("Unable to save compiled %s to any of %s",
+                        path, ', '.join(compiled))
+        return self
+
+    @classmethod
+    def compile(cls, src, dst, cachesize=CACHE_SIZE):
+        """Parse the country file at path src, save its indexes to dst for
+        load_compiled and return the CtyDat. See from_data for the formats
+        src can be in."""
+        self, source = cls._parse(src, cachesize)
+        self._save(dst, source)
+        return self
+
+    @classmethod
+    def _parse(cls, src, cachesize):
+        """Parse the country file at path src. Returns the CtyDat and the
+        (sha1, size, mtime) of src that _save records."""
+        with open(src, 'rb') as flo:
+            data = flo.read()
+        st = os.stat(src)
+        self = cls.from_data(src, data, cachesize)
+        return self, (hashlib.sha1(data).hexdigest(), st.st_size, st.st_mtime)
+
+    def _save(self, dst, source):
+        """Write the indexes to dst, compiled from a file with the given
+        (sha1, size, mtime)."""
+        digest, size, mtime = source
+        blob = marshal.dumps((
+            COMPILED_VERSION, digest, size, mtime,
+            [tuple(dxcc) for dxcc in self.dxcc.itervalues()],
+            dict(self.prefixes), self.exact, self.trie))
+        dirname = os.path.dirname(dst)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        # write aside and rename, so readers never see a partial file
+        tmp = '%s.%d.tmp' % (dst, os.getpid())
         try:
-            a, b, c = fields
-        except Exception:
-            try: a, b = fields
-            except Exception:
-                a = fields
+            with open(tmp, 'wb') as flo:
+                flo.write(blob)
+            os.rename(tmp, dst)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    @classmethod
+    def load_compiled(cls, path, src=None, cachesize=CACHE_SIZE):
+        """Load a CtyDat saved by compile, or return None if there is no
+        usable one at path.
+
+        If src is given, the file must have been compiled from it: it is
+        trusted while src keeps its size and mtime, and otherwise only if
+        src still hashes the same.
+        """
+        try:
+            with open(path, 'rb') as flo:
+                data = marshal.loads(flo.read())
+            version, digest, size, mtime = data[:4]
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if version != COMPILED_VERSION:
+            return None
+        if src is not None:
+            try:
+                st = os.stat(src)
+                if (size, mtime) != (st.st_size, st.st_mtime):
+                    with open(src, 'rb') as flo:
+                        if hashlib.sha1(flo.read()).hexdigest() != digest:
+                            return None
+            except (IOError, OSError):
+                return None
+        dxccs, prefixes, exact, trie = data[4:]
+        self = cls.__new__(cls)
+        self._init_caches(cachesize)
+        self.dxcc = dict((dxcc[-1], Dxcc._make(dxcc)) for dxcc in dxccs)
+        self.prefixes = defaultdict(list, prefixes)
+        self.exact = exact
+        self.trie = trie
+        self.records = self._build_records()
+        return self
+
+    def _build_trie(self):
+        """Compile the prefix aliases into a character trie.
+
+        Each node is a dict from the next character to the child node; a
+        node where an alias ends also maps '' to its index entry.
+        """
+        trie = {}
+        for mainprefix, tests in self.prefixes.iteritems():
+            for test in tests:
+                prefix, overrides = parse_alias(test)
+                node = trie
+                for c in prefix:
+                    node = node.setdefault(c, {})
+                node[''] = _entry(mainprefix, overrides)
+        return trie
+
+    def _build_records(self):
+        """Build the Dxcc record for every index entry.
+
+        Entries with the same entity and overrides share one record, and
+        nothing is modified after construction, so a CtyDat can be shared
+        between threads.
+        """
+        entries = set(self.exact.itervalues())
+        stack = [self.trie]
+        while stack:
+            node = stack.pop()
+            for c, child in node.iteritems():
+                if c:
+                    stack.append(child)
+                else:
+                    entries.add(child)
+        records = {}
+        for mainprefix, overrides in entries:
+            dxcc = self.dxcc[mainprefix]
+            if overrides:
+                dxcc = dxcc._replace(**dict(overrides))
+            if dxcc.prefix in STAR_PREFIXES:
+                dxcc = dxcc._replace(prefix=STAR_PREFIXES[dxcc.prefix])
+            records[mainprefix, overrides] = dxcc
+        return records
+
+    @property
+    def version(self):
+        """Release date of the cty.dat as yyyymmdd, from its =VER entry, or
+        None if it has none."""
+        versions = [mo.group(1) for mo in map(VERSION_RE.match, self.exact)
+                    if mo is not None]
+        return max(versions) if versions else None
 
-        if c is None and None not in (a,b):
-            if b in ('QRP', 'LGT'):
-                b = a
-                a = None
+    def build_dense(self):
+        """Build the table getdxcc uses to resolve plain calls without
+        walking the trie or taking the cache lock.
+
+        It maps every path of up to DENSE_DEPTH characters through the trie
+        to the record of the longest alias along it (None if there is
+        none), or to _DEEP where longer aliases continue it.
+        """
+        dense = {}
+        stack = [('', self.trie, None)]
+        while stack:
+            path, node, best = stack.pop()
+            entry = node.get('')
+            if entry is not None:
+                best = self.records[entry]
+            children = len(node) - (entry is not None)
+            if path:
+                deep = len(path) == DENSE_DEPTH and children
+                dense[path] = _DEEP if deep else best
+            if len(path) < DENSE_DEPTH:
+                for c, child in node.iteritems():
+                    if c:
+                        stack.append((path + c, child, best))
+        self.dense = dense
+        return dense
+
+    def _prefixcall(self, call):
+        """Map special cases and portable calls to a call to match against
+        the prefix trie."""
+        if OH_RE.search(call) is not None:
+            call = 'OH'
+        elif ROTUMA_RE.search(call) is not None:
+            call = '3D2RR'
+        elif CONWAY_RE.search(call) is not None:
+            call = '3D2CR'
+        elif '/' in call:
+            prefix = self.getwpx(call)
+            if prefix is None:
+                prefix = 'QQ'
+            call = prefix + 'AA'
+        return call
+
+    def _match(self, call):
+        """Return the index entry for the longest alias call starts with, or
+        None."""
+        node = self.trie
+        best = None
+        for c in call:
+            node = node.get(c)
+            if node is None:
+                break
+            best = node.get('', best)
+        return best
+
+    def getwpx(self, call):
+        prefix = self._wpx_cache.get(call)
+        if prefix is None:
+            prefix = self._wpx_cache[call] = self._getwpx(call)
+        return prefix
+
+    def _getwpx(self, call):
+        a, b, c = split_call(call)
 
         if b.isdigit():
             raise InvalidCallsign(call)
 
+        prefix = None
         if a is None and c is None:
-            if re.search('\d', b) is not None:
-                prefix = re.search('(.+\d)[A-Z]*', b).group(0)
+            mo = AREA_RE.search(b)
+            if mo is not None:
+                prefix = mo.group(1)
             else:
                 prefix = b[0:2] + '0'
         elif a is None and c is not None:
+            mo = AREA_RE.search(b)
+            if mo is None:
+                raise InvalidCallsign(call)
+            area = mo.group(1)
             if len(c) == 1 and c.isdigit():
-                _1 = re.search('(.+\d)[A-Z]*', b).group(0)
-                mo = re.search('^([A-Z]\d)\d$', _1)
-                if mo is not None:
-                    prefix = _1 + c
-                else:
-                    mo = re.search('(.*[A-Z])\d+', _1)
-                    prefix = mo.group(0) + c
-            elif re.search('(^P$)|(^M{1,2}$)|(^AM$)|(^A$)', c) is not None:
-                mo = re.search('(.+\d)[A-Z]*', b)
-                prefix = mo.group(0)
-            elif re.search('^\d\d+$/', c) is not None:
-                mo = re.search('(.+\d)[A-Z]*', b)
-                prefix = mo.group(0)
+                mo = SHORT_AREA_RE.search(area)
+                if mo is None:
+                    mo = AREA_LETTERS_RE.search(area)
+                prefix = mo.group(1) + c
+            elif PORTABLE_RE.search(c) is not None:
+                prefix = area
+            elif NUMBER_RE.search(c) is not None:
+                prefix = area
             else:
                 if c[-1].isdigit():
                     prefix = c
@@ -105,60 +769,187 @@ class CtyDat(object):
                 prefix = a + '0'
         return prefix
 
-    def getdxcc(self, call):
-        matchchars = 0
-        goodzone = None
-        matchprefix = None
-        if re.search('(^OH/)|(/OH[1-9]?$)', call) is not None:
-            call = 'OH'
-        elif re.search('(^3D2R)|(^3D2.+\/R)', call) is not None:
-            call = '3D2RR'
-        elif re.search('^3D2C', call) is not None:
-            call = '3D2CR'
-        elif '/' in call:
-            prefix = self.getwpx(call)
-            if prefix is None:
-                prefix = 'QQ'
-            call = prefix + 'AA'
+    def getdxcc(self, call, when=None):
+        """Return the Dxcc record for call.
 
-        letter = call[0]
-        for mainprefix, tests in self.prefixes.iteritems():
-            for test in tests:
-                testlen = len(test)
-                if letter != test[0]:
-                    continue
-                zones = ''
-                if testlen > 5 and '(' in test or '[' in test:
-                    mo = re.search('^([A-Z0-9\/]+)([\[\(].+)', test)
-                    if mo.group(1) is not None:
-                        zones += mo.group(1)
-                    testlen = len(mo.group(0))
-
-                if call[:testlen] == test[:testlen] and matchchars <= testlen:
-                    matchchars = testlen
-                    matchprefix = mainprefix
-                    goodzone = zones
+        If the CtyDat has a History (see from_xml and from_eras), when, a
+        UTC datetime such as an ADIF record's app_datetime_on, picks the
+        entity call belonged to at that time. Otherwise when is ignored.
+        """
+        if when is not None and self.history is not None:
+            return self._getdxcc_at(call, when)
+        dense = self.dense
+        if dense is not None and '/' not in call and call[:3] != '3D2':
+            match = self.exact.get(call)
+            if match is not None:
+                return self.records[match]
+            # the longest key present is where a trie walk would stop;
+            # keys are at most DENSE_DEPTH long
+            mydxcc = (dense.get(call[:4]) or dense.get(call[:3]) or
+                      dense.get(call[:2]) or dense.get(call[:1]))
+            if mydxcc is not None and mydxcc is not _DEEP:
+                return mydxcc
+
+        mydxcc = self._dxcc_cache.get(call)
+        if mydxcc is None:
+            mydxcc = self._dxcc_cache[call] = self._getdxcc(call)
+        return mydxcc
+
+    def _getdxcc(self, call):
+        # full calls listed in cty.dat take precedence over any prefix
+        match = self.exact.get(call)
+        if match is None:
+            match = self._match(self._prefixcall(call))
+        if match is None:
+            raise InvalidDxcc(None)
+        return self.records[match]
+
+    def _getdxcc_at(self, call, when):
+        history = self.history
+        mydxcc = None
+        intervals = history.exact.get(call)
+        if intervals is not None:
+            mydxcc = intervals.at(when)
+        if mydxcc is None:
+            mydxcc = history.match(self._prefixcall(call), when)
+        if mydxcc is None:
+            raise InvalidDxcc(None)
+        return mydxcc
+
+    def getdxcc_many(self, calls, columns=False, whens=None):
+        """Look up the DXCC of every call in calls, resolving each distinct
+        call only once.
+
+        Returns a list of getdxcc results aligned with calls, None where a
+        call is invalid or has no DXCC. With columns=True, returns a dict
+        from each of DXCC_COLUMNS to a list aligned with calls instead;
+        lat and lon are arrays of doubles, NaN where unknown. whens, if
+        given, holds the getdxcc when of each call, and each distinct pair
+        is resolved once.
+        """
+        if whens is not None and self.history is not None:
+            calls = zip(calls, whens)
+            getdxcc = lambda key: self._getdxcc_at(*key)
+        else:
+            calls = list(calls)
+            getdxcc = self._getdxcc
+        found = {}
+        for call in set(calls):
+            try:
+                found[call] = getdxcc(call)
+            except (InvalidDxcc, InvalidCallsign):
+                found[call] = None
+        if not columns:
+            return map(found.__getitem__, calls)
+
+        unknown = (None,) * (len(DXCC_COLUMNS) - 2) + (NAN, NAN)
+        for call, dxcc in found.iteritems():
+            if dxcc is None:
+                found[call] = unknown
+            else:
+                found[call] = tuple(dxcc[f] for f in DXCC_COLUMNS[:-2]) + (
+                    float(dxcc['lat']), float(dxcc['lon']))
+        rows = map(found.__getitem__, calls)
+        cols = zip(*rows) if rows else [()] * len(DXCC_COLUMNS)
+        result = dict(zip(DXCC_COLUMNS[:-2], map(list, cols[:-2])))
+        result['lat'] = array('d', cols[-2])
+        result['lon'] = array('d', cols[-1])
+        return result
 
+
+class CtyDatManager(object):
+    """Keep a CtyDat current with the cty.dat file at path.
+
+    Once started, a background thread checks the file every interval seconds
+    and, when it has changed, loads it into a new CtyDat and swaps that in
+    with a single assignment. Lookups through the manager, or through a
+    CtyDat previously taken from it, never wait for or see a half built
+    one. A file that fails to load is logged and the old CtyDat kept.
+    With dense, each CtyDat gets a build_dense table.
+
+        with CtyDatManager(cfg.get('geolog', 'ctydatpath')) as ctydats:
+            ctydats.getdxcc(call)
+    """
+
+    def __init__(self, path, interval=RELOAD_INTERVAL, dense=False,
+                 cachesize=CACHE_SIZE):
+        self.path = path
+        self.interval = interval
+        self.dense = dense
+        self.cachesize = cachesize
+        self._stop = threading.Event()
+        self._thread = None
+        self._stat = None
+        self.reload()
+
+    @property
+    def ctydat(self):
+        return self._current[0]
+
+    @property
+    def loaded(self):
+        """time.time() when the current CtyDat was loaded."""
+        return self._current[1]
+
+    @property
+    def version(self):
+        return self._current[0].version
+
+    def getdxcc(self, call, when=None):
+        return self._current[0].getdxcc(call, when)
+
+    def getwpx(self, call):
+        return self._current[0].getwpx(call)
+
+    def getdxcc_many(self, calls, columns=False, whens=None):
+        return self._current[0].getdxcc_many(calls, columns, whens)
+
+    def reload(self):
+        """Load path now and make it the current CtyDat."""
+        st = os.stat(self.path)
+        ctydat = CtyDat.from_path(self.path, cachesize=self.cachesize)
+        if self.dense:
+            ctydat.build_dense()
+        self._stat = st.st_size, st.st_mtime
+        # one assignment, so readers get a matching CtyDat and timestamp
+        self._current = ctydat, time.time()
+        log.info("Loaded %s version %s", self.path, ctydat.version)
+        return ctydat
+
+    def check(self):
+        """Reload path if it has changed since it was loaded. Returns
+        whether it did."""
         try:
-            mydxcc = self.dxcc[matchprefix]
-        except KeyError:
-            raise InvalidDxcc(matchprefix)
+            st = os.stat(self.path)
+            if (st.st_size, st.st_mtime) == self._stat:
+                return False
+            self.reload()
+        except Exception:
+            log.exception("Failed to reload %s", self.path)
+            return False
+        return True
 
-        if goodzone is not None:
-            mo = re.search('\((\d+)\)', goodzone)
-            if mo is not None:
-                mydxcc['cq'] = mo.group(0)
-            mo = re.search('\[(\d+)\]', goodzone)
-            if mo is not None:
-                mydxcc['itu'] = mo.group(0)
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='CtyDatManager')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
 
-        if mydxcc['prefix'].startswith('*'):
-            if (mydxcc['prefix'] == '*TA1'):  mydxcc['prefix'] = "TA"  # Turkey
-            if (mydxcc['prefix'] == '*4U1V'): mydxcc['prefix'] = "OE"  # 4U1VIC is in OE..
-            if (mydxcc['prefix'] == '*GM/s'): mydxcc['prefix'] = "GM"  # Shetlands
-            if (mydxcc['prefix'] == '*IG9'):  mydxcc['prefix'] = "I"  # African Italy
-            if (mydxcc['prefix'] == '*IT9'):  mydxcc['prefix'] = "I"  # Sicily
-            if (mydxcc['prefix'] == '*JW/b'): mydxcc['prefix'] = "JW"  # Bear Island
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
 
-        return mydxcc
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def __enter__(self):
+        return self.start()
 
+    def __exit__(self, *exc):
+        self.stop()
@@ -19,12 +19,14 @@
 import argparse
 import ConfigParser
 import logging
+from multiprocessing import Pool
 import os
 import sys
 import traceback
-from pkg_resources import resource_stream
+from pkg_resources import resource_filename
 import geojson as gj
 from hamtools import adif
+from hamtools import cabrillo
 from hamtools.ctydat import CtyDat, InvalidDxcc, InvalidCallsign
 from hamtools import kml
 from hamtools import qrz
@@ -41,10 +43,6 @@ log = logging.getLogger(__name__)
 # 3. Cache georeferenced calls
 # 4. Output GeoJSON
 
-CABRILLO_FIELDS = ['header', 'freq', 'mode', 'date', 'time',
-                   'from_call', 'sent_rst', 'sent_ex', 'call', 'receved_rst',
-                   'received_ex']
-
 CACHEPATH = os.path.join(os.environ['HOME'], '.qrz_cache')
 
 
@@ -66,10 +64,23 @@ class NotFound(GeoRefError): pass
 class QrzReferencer(object):
     def __init__(self, session):
         self.session = session
+        self.memo = {}
 
-    ## TODO memoize and cache
     def reference(self, callsign):
-        """Returns lon, lat from QRZ"""
+        """Returns lon, lat from QRZ, remembering the answer for callsign"""
+        try:
+            result = self.memo[callsign]
+        except KeyError:
+            try:
+                result = self._reference(callsign)
+            except (NotFound, NullLoc), e:
+                result = e
+            self.memo[callsign] = result
+        if isinstance(result, GeoRefError):
+            raise result
+        return result
+
+    def _reference(self, callsign):
         try:
             rec = self.session.qrz(callsign)
             if None in (rec['lat'], rec['lon']):
@@ -129,6 +140,15 @@ class FCCReferencer(object):
             raise
 
 
+def make_drivers(sess, ctydat):
+    """Georeferencing drivers in order of preference"""
+    drivers = []
+    sess and drivers.append(QrzReferencer(sess))
+    drivers.append(FCCReferencer())
+    ctydat and drivers.append(CtyDatReferencer(ctydat))
+    return drivers
+
+
 class Log(object):
     def __init__(self):
         self.qsos = []
@@ -137,24 +157,24 @@ class Log(object):
     @staticmethod
     def from_cabrillo(logfile):
         self = Log()
-        for line in logfile:
-            if line.startswith("QSO"):
-                qso = dict(zip(CABRILLO_FIELDS, line.split()))
-                # Pygeojson just repr's numbers, which doesn't add .0 to
-                # floats, which makes them JSON ints, which QGIS won't allow to
-                # use for a graduated scale.
-                qso['time'] = float(qso['time'] + '.000000001')
-                try:
-                    freq = float(qso['freq']) + 0.00000001
-                except ValueError:
-                    pass
-                else:
-                    qso['freq'] = freq
-                self.qsos.append(qso)
-                log.debug(qso)
-            elif line.startswith("CALLSIGN:"):
-                self.callsign = line.split()[1]
-                log.info("Callsign: %s" % self.callsign)
+        reader = cabrillo.Reader(logfile)
+        self.callsign = reader.callsign
+        log.info("Callsign: %s" % self.callsign)
+        log.info("Contest: %s, template %r" % (reader.contest, reader.template))
+        for rec in reader:
+            qso = dict(zip(rec._fields, rec))
+            # Pygeojson just repr's numbers, which doesn't add .0 to
+            # floats, which makes them JSON ints, which QGIS won't allow to
+            # use for a graduated scale.
+            qso['time'] = float(qso['time'] + '.000000001')
+            try:
+                freq = float(qso['freq']) + 0.00000001
+            except ValueError:
+                pass
+            else:
+                qso['freq'] = freq
+            self.qsos.append(qso)
+            log.debug(qso)
         log.info("Read %d records" % len(self.qsos))
         return self
 
@@ -189,11 +209,10 @@ class Log(object):
         else:
             raise GeoRefFail(callsign)
 
-    def georeference(self, sess, ctydat):
-        drivers = self.drivers = []
-        sess and drivers.append(QrzReferencer(sess))
-        drivers.append(FCCReferencer())
-        ctydat and drivers.append(CtyDatReferencer(ctydat))
+    def georeference(self, sess=None, ctydat=None, drivers=None):
+        if drivers is None:
+            drivers = make_drivers(sess, ctydat)
+        self.drivers = drivers
 
         if not drivers:
             raise Exception("No georef drivers")
@@ -260,37 +279,108 @@ class Log(object):
         dom.writepretty(file)
 
 
-def geolog(logfilepath, outfile, username, password, cachepath, ctydatflo):
+def load_log(logfilepath):
+    """Read an ADIF or Cabrillo log, telling which by its first line"""
     with open(logfilepath) as logfile:
         line = logfile.next()
 
     with open(logfilepath) as logfile:
         if line.startswith('START-OF-LOG'):
             log.info("Opened Cabrillo format log %r" % logfile)
-            qsolog = Log.from_cabrillo(logfile)
+            return Log.from_cabrillo(logfile)
         else:
             log.info("Opened ADIF format log %r" % logfile)
-            qsolog = Log.from_adif(logfile)
+            return Log.from_adif(logfile)
 
-    ctydat = CtyDat(ctydatflo)
-    with qrz.Session(username, password, cachepath) as sess:
-        qsolog.georeference(sess, ctydat)
 
-    points, lines = qsolog.geojson_dumps(sort_keys=True)
+def write_outputs(qsolog, outfile):
+    qth, pointsFC, linesFC = qsolog.geojson()
 
     pointfile = '_'.join((outfile, 'points.geojson'))
     with open(pointfile, "w") as pointfile:
-        pointfile.write(points)
+        pointfile.write(gj.dumps(pointsFC, sort_keys=True))
 
     linefile = '_'.join((outfile, 'lines.geojson'))
     with open(linefile, "w") as linefile:
-        linefile.write(lines)
+        linefile.write(gj.dumps(linesFC, sort_keys=True))
 
     kmlfile = ''.join((outfile, '.kml'))
     with open(kmlfile, "w") as kmlfile:
         qsolog.write_kml(kmlfile)
 
 
+def geolog(logfilepath, outfile, username, password, cachepath, ctydat):
+    qsolog = load_log(logfilepath)
+
+    if not isinstance(ctydat, CtyDat):
+        ctydat = CtyDat(ctydat)
+    with qrz.Session(username, password, cachepath) as sess:
+        qsolog.georeference(sess, ctydat)
+
+    write_outputs(qsolog, outfile)
+
+
+# per process state of geolog_batch workers
+_worker = {}
+
+
+def _init_worker(key, cachepath, ctydat):
+    sess = qrz.Session(key=key, cachepath=cachepath)
+    _worker['drivers'] = make_drivers(sess, ctydat)
+
+
+def _geolog_one(args):
+    logfilepath, outfile = args
+    try:
+        qsolog = load_log(logfilepath)
+        qsolog.georeference(drivers=_worker['drivers'])
+        write_outputs(qsolog, outfile)
+    except Exception, e:
+        log.error("Failed on log %s: %s", logfilepath, traceback.format_exc())
+        return logfilepath, repr(e)
+    return logfilepath, None
+
+
+def geolog_batch(logdir, outdir, username, password, cachepath, ctydat,
+                 jobs=None):
+    """Run geolog on every log file in logdir, in a pool of jobs processes.
+
+    Outputs for logdir/foo.log are prefixed outdir/foo; outdir is created if
+    it does not exist. cty.dat is parsed and
+    QRZ.com logged into once; each worker then keeps one QRZ cache
+    connection and one set of georeferencing drivers, with their lookup
+    memos, for all the logs it handles. ctydat is a CtyDat or an open
+    cty.dat file. Returns the paths of logs which failed.
+    """
+    tasks = []
+    for name in sorted(os.listdir(logdir)):
+        path = os.path.join(logdir, name)
+        if name.startswith('.') or not os.path.isfile(path):
+            continue
+        tasks.append((path, os.path.join(outdir, os.path.splitext(name)[0])))
+    log.info("Processing %d logs from %s" % (len(tasks), logdir))
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    if not isinstance(ctydat, CtyDat):
+        ctydat = CtyDat(ctydat)
+    with qrz.Session(username, password, cachepath) as sess:
+        key = sess.key
+
+    failed = []
+    pool = Pool(jobs, _init_worker, (key, cachepath, ctydat))
+    try:
+        for logfilepath, error in pool.imap_unordered(_geolog_one, tasks):
+            if error:
+                failed.append(logfilepath)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    log.info("Processed %d logs, %d failed" % (len(tasks), len(failed)))
+    return failed
+
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv
@@ -302,9 +392,13 @@ prefixed with output path. E.g. given "foo/bar", the following files will be
 created: "foo/bar_points.geojson", "foo/bar_lines.geojson", and "foo/bar.kml"
 """)
     parser.add_argument('infile', type=str,
-                        help='Input log file (ADIF or Cabrillo)')
+                        help='Input log file (ADIF or Cabrillo), or directory of logs with --batch')
     parser.add_argument('outpath', type=str,
-                        help='Output path prefix')
+                        help='Output path prefix, or output directory with --batch')
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='Process every log in the input directory', default=False)
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='Number of worker processes for --batch', default=None)
     parser.add_argument('-c', '--cfg', type=str,
                         help='Config file path', default=os.path.join(os.environ['HOME'], '.geologrc'))
     parser.add_argument('-v', '--verbose', type=bool,
@@ -336,14 +430,19 @@ created: "foo/bar_points.geojson", "foo/bar_lines.geojson", and "foo/bar.kml"
         cachepath = CACHEPATH
 
     try:
-        ctydatpath = cfg.get('geolog', 'cachepath')
-        ctydatflo = open(ctydatpath)
+        ctydatpath = cfg.get('geolog', 'ctydatpath')
     except ConfigParser.Error:
-        ctydatflo = resource_stream(__name__, "ctydat/cty.dat")
+        ctydatpath = resource_filename(__name__, "ctydat/cty.dat")
+    ctydat = CtyDat.from_path(ctydatpath)
 
     log.info("QRZ cache: %s" % cachepath)
 
-    geolog(args.infile, args.outpath, un, pw, cachepath, ctydatflo)
+    if args.batch:
+        failed = geolog_batch(args.infile, args.outpath, un, pw, cachepath,
+                              ctydat, args.jobs)
+        return 1 if failed else 0
+
+    geolog(args.infile, args.outpath, un, pw, cachepath, ctydat)
 
     return 0
 
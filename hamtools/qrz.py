@@ -17,7 +17,7 @@
 #
 
 import httplib, urllib
-from xml.dom import minidom
+from xml.etree import cElementTree
 import sys
 import os
 import sqlite3
@@ -49,36 +49,51 @@ class CallMismatch(QrzError):
 class QrzRequestError(QrzError):
     pass
 
+def _tag(elem):
+    """Element tag without its {namespace}."""
+    return elem.tag.rsplit('}', 1)[-1]
+
+def parse_response(xml):
+    """Parse a QRZ.com XML response into (callsign, session) dicts of the
+    fields in its Callsign and Session elements, keyed by tag. Either is
+    empty if the response has no such element."""
+    sections = dict(Callsign={}, Session={})
+    for elem in cElementTree.fromstring(xml):
+        fields = sections.get(_tag(elem))
+        if fields is not None:
+            for child in elem:
+                fields[_tag(child)] = child.text
+    return sections['Callsign'], sections['Session']
+
 class Callsign(object):
     conversions = dict(
         lat=float,
         lon=float,
     )
 
-    def __init__(self, node):
-        self.node = node
+    def __init__(self, fields):
+        self.fields = fields
 
     def __getitem__(self, key):
-        try:
-            value = self.node.getElementsByTagName(key)[0].firstChild.data
-        except IndexError, e:
-            return None
-        if key in self.conversions.keys():
+        value = self.fields.get(key)
+        if value is not None and key in self.conversions:
             value = self.conversions[key](value)
         return value
 
+    def __repr__(self):
+        return '<Callsign %r>' % self.fields
+
 class Session(object):
     def __init__(self, user=None, passwd=None, cachepath=CACHEPATH, key=None):
         # post http://xml.qrz.com/xml?username=user;password=passwdo
-        # self.key = minidom parse key
-        # check for alert or error
+        # check for error, then keep the session key
         if not key:
             xml = self.request(dict(username=user, password=passwd))
             log.debug(xml)
-            dom = minidom.parseString(xml)
-            session = dom.getElementsByTagName("Session")[0]
-            self.checkErr(session)
-            key = session.getElementsByTagName("Key")[0].firstChild.data
+            session = parse_response(xml)[1]
+            if session.get('Error') or not session.get('Key'):
+                raise QrzError(session.get('Error', "No session key"))
+            key = session['Key']
         self.key = key
         self.db = sqlite3.connect(cachepath)
         self.db.text_factory = str
@@ -119,9 +134,8 @@ class Session(object):
             miss = False
             xml = xml[0]
         try:
-            dom = minidom.parseString(xml)
-            session = Callsign(dom.getElementsByTagName("Session")[0])
-            e = session['Error']
+            fields, session = parse_response(xml)
+            e = session.get('Error')
             if e:
                 if not e.startswith("Not found"):
                     raise QrzError(e)
@@ -130,9 +144,8 @@ class Session(object):
                 self.db.commit();
             if e:
                 raise NotFound(callsign)
-            callnode = dom.getElementsByTagName("Callsign")[0]
-            data = Callsign(callnode)
-            if data['call'].lower() != callsign.lower():
+            data = Callsign(fields)
+            if (data['call'] or '').lower() != callsign.lower():
                 raise CallMismatch("Calls do not match", data['call'], callsign)
             return data
         except QrzError, e:
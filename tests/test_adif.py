@@ -73,3 +73,212 @@ def test_version():
     reader = hamtools.adif.Reader(flo)
     eq_(reader.adif_ver, '1.00')
 
+
+
+def test_engines_agree():
+    fast = list(hamtools.adif.Reader(StringIO.StringIO(TEST_ADIF))._lex())
+    ref = list(hamtools.adif.Reader(StringIO.StringIO(TEST_ADIF),
+                                    engine='reference')._lex())
+    eq_(fast, ref)
+    eq_(len(fast), 27)
+
+
+def test_fast_lex_long_body():
+    body = 'x<y>' * 1000
+    adif = '<comment:%d>%s<call:5>AB9RN<eor>' % (len(body), body)
+    reader = hamtools.adif.Reader(StringIO.StringIO(adif))
+    fields = list(reader._lex(blocksize=7))
+    eq_(fields[0], hamtools.adif.Field(name='comment', type='', body=body))
+    eq_(fields[1], hamtools.adif.Field(name='call', type='', body='AB9RN'))
+
+
+def test_mmap_reader(tmpdir):
+    path = tmpdir.join('test.adi')
+    path.write(TEST_ADIF)
+    expected = list(hamtools.adif.Reader(StringIO.StringIO(TEST_ADIF)))
+    with hamtools.adif.Reader.from_path(str(path)) as reader:
+        eq_(reader.adif_ver, '1.00')
+        i1, i2 = iter(reader), iter(reader)
+        eq_(i1.next(), expected[0])
+        eq_(list(i2), expected)
+        eq_(list(i1), expected[1:])
+
+
+def test_lexer_offset():
+    lexer = hamtools.adif.Lexer('hdr <eoh> <call:5>AB9RN<eor>')
+    fields = iter(lexer)
+    fields.next()
+    eq_(lexer.offset, 9)
+    fields.next()
+    eq_(lexer.offset, 23)
+
+
+def test_parallel_read(tmpdir, monkeypatch):
+    monkeypatch.setattr(hamtools.adif, 'MIN_CHUNK', 1)
+    # the comment body contains an <eor> that must not be split on
+    tricky = '<comment:11>fake <eor> <call:4>N1YW<eor>\n'
+    path = tmpdir.join('test.adi')
+    path.write(TEST_ADIF + tricky * 20 + TEST_ADIF.split('<eoh>')[1] * 20)
+    expected = list(hamtools.adif.Reader.from_path(str(path)))
+    records = list(hamtools.adif.parallel_read(str(path), workers=3,
+                                               chunks=50))
+    eq_(len(records), 83)
+    eq_(records, expected)
+    calls = list(hamtools.adif.parallel_read(str(path), workers=3, chunks=50,
+                                             func=_call_and_date))
+    eq_(calls, map(_call_and_date, expected))
+
+
+def _call_and_date(rec):
+    return rec['call'], rec.get('app_datetime_on')
+
+
+def test_qso_table():
+    table = hamtools.adif.Reader(StringIO.StringIO(TEST_ADIF)).table()
+    records = list(hamtools.adif.Reader(StringIO.StringIO(TEST_ADIF)))
+    for rec in records:
+        del rec['app_datetime_on']
+    eq_(len(table), 3)
+    eq_([dict(row) for row in table], records)
+    eq_(dict(table[-1]), records[-1])
+    eq_(table.column('call'), ['AB9RN', 'K4NNQ', 'KC0YSH'])
+    eq_(list(table.floats('freq')), [14.15] * 3)
+    eq_(table.columns['freq'].values, [None, '14.150'])
+
+    table.append({'call': 'N1YWB', 'band': '20m'})
+    eq_(table.column('band'), [None, None, None, '20m'])
+    eq_(len(table[2:]), 2)
+    assert 'freq' not in table[3]
+
+
+def test_typed_record():
+    rec = hamtools.adif.TypedRecord({
+        'call': 'AB9RN', 'freq': '14.150', 'mode': 'ssb',
+        'qso_date': '20120714', 'time_on': '1206', 'time_off': '120730',
+        'lat': 'S033 30.000', 'swl': 'N'})
+    eq_(rec.cache, {})
+    eq_(rec['freq'], 14.15)
+    eq_(rec['mode'], 'SSB')
+    eq_(rec['lat'], -33.5)
+    eq_(rec['swl'], False)
+    eq_(rec['app_datetime_off'], datetime(2012, 7, 14, 12, 7, 30))
+    eq_(sorted(rec.cache), ['app_datetime_off', 'freq', 'lat', 'mode',
+                            'qso_date', 'swl', 'time_off'])
+    eq_(len(rec), 10)
+    with pytest.raises(hamtools.adif.ParseError):
+        hamtools.adif.TypedRecord({'qso_date': '2012071'})['qso_date']
+
+
+def test_typed_reader():
+    reader = hamtools.adif.Reader(StringIO.StringIO(TEST_ADIF))
+    rec = reader.typed().next()
+    assert 'app_datetime_on' not in rec.raw
+    assert 'app_datetime_on' in rec
+    eq_(rec['app_datetime_on'], datetime(2012, 07, 14, 12, 0))
+    eq_(rec['call'], 'AB9RN')
+    table = hamtools.adif.Reader(StringIO.StringIO(TEST_ADIF)).table()
+    eq_(dict(hamtools.adif.TypedRecord(table[0])), dict(rec))
+
+
+def test_writer():
+    records = list(hamtools.adif.Reader(StringIO.StringIO(TEST_ADIF)))
+    records[0]['app_datetime_off'] = datetime(2012, 07, 14, 12, 5)
+    flo = StringIO.StringIO()
+    with hamtools.adif.Writer(flo, 'test\n', '1.00', bufsize=100) as writer:
+        writer.write(records[0])
+        writer.write_many(records[1:])
+    out = flo.getvalue()
+    assert out.startswith('test\n<adif_ver:4>1.00<eoh>\n<call:5>AB9RN')
+    assert 'app_datetime' not in out
+    eq_(list(hamtools.adif.Reader(StringIO.StringIO(out))),
+        list(hamtools.adif.Reader(StringIO.StringIO(TEST_ADIF))))
+
+
+def test_from_bytes():
+    data = '<call:5>AB9RN<name:7>J\xc3\xbcrgen<freq:6>14.150<eor>'
+    for buf in (data, bytearray(data), memoryview(data)):
+        reader = hamtools.adif.Reader.from_bytes(buf, encoding='utf-8')
+        rec = reader.typed().next()
+        eq_(rec.raw['name'], 'J\xc3\xbcrgen')
+        eq_(rec['name'], u'J\xfcrgen')
+        eq_(rec['freq'], 14.15)
+        eq_(sorted(rec.cache), ['freq', 'name'])
+
+
+def test_projection():
+    for engine in hamtools.adif.ENGINES:
+        reader = hamtools.adif.Reader(
+            StringIO.StringIO(TEST_ADIF), engine=engine,
+            fields=['CALL', 'qso_date', 'time_on'],
+            where=lambda rec: rec['call'].startswith('K'))
+        eq_(list(reader), [
+            {'call': 'K4NNQ', 'qso_date': '20120714', 'time_on': '1206',
+             'app_datetime_on': datetime(2012, 07, 14, 12, 6)},
+            {'call': 'KC0YSH', 'qso_date': '20120714', 'time_on': '1206',
+             'app_datetime_on': datetime(2012, 07, 14, 12, 6)}])
+
+
+def test_lexer_skip_long_body():
+    body = 'x' * 100
+    adif = '<comment:%d>%s<call:5>AB9RN<eor>' % (len(body), body)
+    flo = StringIO.StringIO(adif)
+    lexer = hamtools.adif.Lexer(flo.read(7), 0, flo.read, 7,
+                                fields=set(['call', 'eor']))
+    eq_([f.name for f in lexer], ['call', 'eor'])
+    eq_(lexer.offset, len(adif))
+
+
+def test_record_index(tmpdir):
+    path = tmpdir.join('test.adi')
+    path.write(TEST_ADIF)
+    records = list(hamtools.adif.Reader(StringIO.StringIO(TEST_ADIF)))
+    for mmap in (True, False):
+        with hamtools.adif.Reader.from_path(str(path), mmap=mmap,
+                                            index=True) as reader:
+            eq_(reader.index.calls, ['AB9RN', 'K4NNQ', 'KC0YSH'])
+            eq_(reader[1], records[1])
+            eq_(reader[-1], records[2])
+            eq_(reader[::2], records[::2])
+            reader.seek_record(2)
+            eq_(list(reader), records[2:])
+    assert tmpdir.join('test.adi.idx').check()
+
+    path.write(TEST_ADIF + '<call:4>N1YW<eor>')
+    with hamtools.adif.Reader.from_path(str(path), index=True) as reader:
+        eq_(len(reader.index), 4)
+        eq_(reader[3], {'call': 'N1YW'})
+    eq_(len(hamtools.adif.RecordIndex.load(str(path) + '.idx')), 4)
+
+    # an index rebuilt after seek_record still covers the whole file
+    with hamtools.adif.Reader.from_path(str(path), index=True) as reader:
+        reader.seek_record(2)
+        tmpdir.join('test.adi.idx').remove()
+        reader.load_index()
+        eq_(len(reader.index), 4)
+        eq_(reader[0]['call'], 'AB9RN')
+    eq_(len(hamtools.adif.RecordIndex.load(str(path) + '.idx')), 4)
+
+
+def test_follow(tmpdir):
+    path = tmpdir.join('test.adi')
+    path.write(TEST_ADIF + '<call:4>N1')
+    reader = hamtools.adif.Reader.from_path(str(path), mmap=False)
+    follow = reader.follow(interval=0)
+    eq_([follow.next()['call'] for i in range(3)],
+        ['AB9RN', 'K4NNQ', 'KC0YSH'])
+    with open(str(path), 'a') as flo:
+        flo.write('YW<eor><call:5>')
+    eq_(follow.next(), {'call': 'N1YW'})
+    eq_(reader.follow_pos, len(TEST_ADIF) + 17)
+    with open(str(path), 'a') as flo:
+        flo.write('AB9RN<eor>')
+    eq_(follow.next(), {'call': 'AB9RN'})
+
+
+def test_negative_length():
+    data = 'hdr <eoh>\n<call:5>AB9RN<eor><call:-20>K1ABC<eor>'
+    with pytest.raises(hamtools.adif.ParseError):
+        list(hamtools.adif.Reader(StringIO.StringIO(data)))
+    # skipped fields are checked too
+    with pytest.raises(hamtools.adif.ParseError):
+        list(hamtools.adif.Reader(StringIO.StringIO(data), fields=['band']))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Cabrillo reader tests"""
+import cStringIO as StringIO
+import hamtools.cabrillo
+
+import pytest
+
+TEST_CABRILLO = """\
+START-OF-LOG: 3.0
+CONTEST: ARRL-10
+CALLSIGN: N5KO
+ADDRESS: 1 Main St
+ADDRESS: Anytown
+QSO: 28050 CW 2000-12-09 0000 N5KO          599 CA     KO1H          599 ME
+QSO: 28050 CW 2000-12-09 0001 N5KO          599 CA     W1AW          599 CT     1
+END-OF-LOG:
+"""
+
+CQWW = """\
+START-OF-LOG: 3.0
+CONTEST: FOO-BAR
+CALLSIGN: N6TW
+QSO:  3799 PH 2000-11-26 0711 N6TW          59  03     JT1Z          59  23     0
+QSO:  3799 PH 2000-11-26 0712 N6TW          59  03     K1AR          59  05
+"""
+
+
+def test_header():
+    reader = hamtools.cabrillo.Reader(StringIO.StringIO(TEST_CABRILLO))
+    assert reader.callsign == 'N5KO'
+    assert reader.contest == 'ARRL-10'
+    assert reader.header['ADDRESS'] == '1 Main St\nAnytown'
+    assert reader.template is hamtools.cabrillo.TEMPLATES['ARRL-10']
+
+
+def test_records():
+    reader = hamtools.cabrillo.Reader(StringIO.StringIO(TEST_CABRILLO))
+    qsos = list(reader)
+    assert len(qsos) == 2
+    assert qsos[0] == ('28050', 'CW', '2000-12-09', '0000', 'N5KO', '599',
+                       'CA', 'KO1H', '599', 'ME', None)
+    assert qsos[1].call == 'W1AW'
+    assert qsos[1].transmitter == '1'
+    assert list(reader) == qsos
+
+
+def test_generic_template():
+    qsos = list(hamtools.cabrillo.Reader(StringIO.StringIO(CQWW)))
+    assert qsos[0].sent_ex == '59 03'
+    assert qsos[0].call == 'JT1Z'
+    assert qsos[0].rcvd_ex == '59 23'
+    assert qsos[0].transmitter == '0'
+    assert qsos[1].call == 'K1AR'
+    assert qsos[1].transmitter is None
+
+
+def test_template_registry():
+    get = hamtools.cabrillo.get_template
+    assert get('CQ-WW-SSB') is hamtools.cabrillo.TEMPLATES['CQ-WW']
+    assert get('naqp-cw').name == 'NAQP'
+    assert get('CQ-WW-RTTY').name == 'CQ-WW-RTTY'
+    assert get('FOO-BAR') is hamtools.cabrillo.GENERIC
+    assert get(None) is hamtools.cabrillo.GENERIC
+
+    reader = hamtools.cabrillo.Reader(
+        StringIO.StringIO(CQWW.replace('FOO-BAR', 'CQ-WW-SSB')))
+    qso = iter(reader).next()
+    assert (qso.sent_zone, qso.call, qso.rcvd_zone) == ('03', 'JT1Z', '23')
+
+
+def test_pattern_template():
+    split = hamtools.cabrillo.get_template('CQ-WW-RTTY').split
+    qso = split('QSO: 14085 RY 2011-09-24 0000 N5KO 599 05 CA JA1ZLO 599 25\n')
+    assert (qso.sent_qth, qso.call, qso.rcvd_qth) == ('CA', 'JA1ZLO', None)
+    with pytest.raises(hamtools.cabrillo.ParseError):
+        split('QSO: 14085 RY\n')
+
+
+def test_column_template():
+    template = hamtools.cabrillo.ColumnTemplate(
+        'TEST', ['freq', 'mode', 'call'], [(5, 10), (11, 13), (14, 20)])
+    assert template.split('QSO: 28050 CW K1AR') == ('28050', 'CW', 'K1AR')
+
+
+def test_writer_roundtrip():
+    reader = hamtools.cabrillo.Reader(StringIO.StringIO(TEST_CABRILLO))
+    flo = StringIO.StringIO()
+    header = [('CONTEST', 'ARRL-10'), ('CALLSIGN', 'N5KO'),
+              ('ADDRESS', '1 Main St\nAnytown')]
+    with hamtools.cabrillo.Writer(flo, header, bufsize=10) as writer:
+        writer.write_many(reader)
+    out = flo.getvalue()
+    assert out.startswith('START-OF-LOG: 3.0\nCONTEST: ARRL-10\n')
+    assert out.endswith('END-OF-LOG:\n')
+    assert ('QSO: 28050 CW 2000-12-09 0000 N5KO          599 CA     '
+            'KO1H          599 ME\n') in out
+    again = hamtools.cabrillo.Reader(StringIO.StringIO(out))
+    assert again.header['ADDRESS'] == '1 Main St\nAnytown'
+    assert list(again) == list(reader)
+
+
+def test_adif_to_cabrillo():
+    records = [
+        {'call': 'K4NNQ', 'freq': '14.150', 'mode': 'USB',
+         'qso_date': '20120714', 'time_on': '120630', 'rst_sent': '59',
+         'rst_rcvd': '57', 'cqz': '5'},
+        {'call': 'W1AW', 'freq': '144.2', 'mode': 'CW',
+         'qso_date': '20120714', 'time_on': '1207', 'cqz': '5'},
+    ]
+    flo = StringIO.StringIO()
+    hamtools.cabrillo.adif_to_cabrillo(
+        iter(records), flo, [('CONTEST', 'CQ-WW-SSB'), ('CALLSIGN', 'AB9RN')],
+        defaults={'sent_zone': '4'})
+    qsos = list(hamtools.cabrillo.Reader(StringIO.StringIO(flo.getvalue())))
+    assert qsos[0] == ('14150', 'PH', '2012-07-14', '1206', 'AB9RN', '59',
+                       '4', 'K4NNQ', '57', '5', None)
+    assert (qsos[1].freq, qsos[1].mode) == ('144', 'CW')
@@ -1,7 +1,14 @@
 #!/usr/bin/env python
 """Describe file"""
-from hamtools.ctydat import CtyDat
-from pkg_resources import resource_stream
+from array import array
+from cStringIO import StringIO
+from datetime import datetime
+import math
+
+from hamtools import ctydat as ctydat_module
+from hamtools.ctydat import (COMPILED_SUFFIX, CtyDat, CtyDatManager,
+                              InvalidCallsign, InvalidDxcc, split_call)
+from pkg_resources import resource_stream, resource_string
 import pytest
 
 call = 'SW8/SW1KYQ//P'
@@ -16,3 +23,270 @@ def ctydat():
 def test_getwpx(ctydat):
     assert ctydat.getwpx(call) == 'SW8'
 
+
+
+def test_getdxcc(ctydat):
+    assert ctydat.getdxcc('W1AW')['prefix'] == 'K'
+    assert ctydat.getdxcc('KH6XX')['prefix'] == 'KH6'
+    assert ctydat.getdxcc('TA1AA')['prefix'] == 'TA'
+
+
+def test_getdxcc_zone_override(ctydat):
+    k0 = ctydat.getdxcc('K0AR')
+    assert (k0['prefix'], k0['cq'], k0['itu']) == ('K', '04', '07')
+    assert ctydat.getdxcc('W1AW')['cq'] == '05'
+    assert ctydat.dxcc['K']['cq'] == '05'
+
+
+def test_getdxcc_exact_call(ctydat):
+    assert '=4Y1CAO[4]' not in ctydat.prefixes['VE']
+    assert ctydat.getdxcc('AC7N')['prefix'] == 'KH6'
+    assert ctydat.getdxcc('3D2AG/P')['prefix'] == '3D2/r'
+    ve = ctydat.getdxcc('4Y1CAO')
+    assert (ve['prefix'], ve['itu']) == ('VE', '04')
+
+
+@pytest.mark.parametrize('call, prefix', [
+    ('W1AW', 'W1'),
+    ('W1AW/4', 'W4'),
+    ('A45XR/7', 'A47'),
+    ('W1AW/P', 'W1'),
+    ('W1AW/QRP', 'W1'),
+    ('W1AW/KH6', 'KH6'),
+    ('DL/W1AW', 'DL0'),
+])
+def test_getwpx_portable(ctydat, call, prefix):
+    assert ctydat.getwpx(call) == prefix
+
+
+def test_split_call():
+    assert split_call('SW8/SW1KYQ//P') == ('SW8', 'SW1KYQ', 'P')
+    assert split_call('DJ1YFK/KH6') == (None, 'DJ1YFK', 'KH6')
+    with pytest.raises(InvalidCallsign):
+        split_call('A/B/C/D')
+
+
+def test_cache_bounded():
+    ctydat = CtyDat(resource_stream('hamtools', "ctydat/cty.dat"), cachesize=2)
+    for call in ('W1AW', 'K0AR', 'TA1AA'):
+        ctydat.getdxcc(call)
+    assert len(ctydat._dxcc_cache) == 2
+    assert ctydat._dxcc_cache.get('W1AW') is None
+    assert ctydat.getdxcc('W1AW')['prefix'] == 'K'
+
+
+def test_getdxcc_many(ctydat):
+    calls = ['W1AW', 'TA1AA', '1234', 'W1AW']
+    found = ctydat.getdxcc_many(calls)
+    assert [d and d['prefix'] for d in found] == ['K', 'TA', None, 'K']
+    cols = ctydat.getdxcc_many(iter(calls), columns=True)
+    assert cols['prefix'] == ['K', 'TA', None, 'K']
+    assert cols['cq'] == ['05', '20', None, '05']
+    assert len(cols['lat']) == 4
+    assert cols['lat'][0] == float(ctydat.dxcc['K']['lat'])
+    assert math.isnan(cols['lon'][2])
+    assert ctydat.getdxcc_many([], columns=True)['lat'] == array('d')
+
+
+def test_getdxcc_records_immutable(ctydat):
+    k = ctydat.getdxcc('W1AW')
+    assert k is ctydat.dxcc['K']
+    assert (k.prefix, k.cq) == (k['prefix'], k['cq']) == ('K', '05')
+    with pytest.raises(AttributeError):
+        k.cq = '4'
+    assert 'cq' in k and 'count' not in k and 'K' not in k
+    assert k.get('cont') == 'NA' and k.get('nope') is None
+    assert k.keys() == ctydat.fields
+    with pytest.raises(KeyError):
+        k['count']
+    assert k[-1] == 'K'
+    ta = ctydat.getdxcc('TA1AA')
+    assert ta.prefix == 'TA'
+    assert ctydat.dxcc['*TA1'].prefix == '*TA1'
+    assert ctydat.getdxcc('K0AR') is ctydat.getdxcc('K0AB')
+
+
+def test_compile(tmpdir):
+    src = tmpdir.join('cty.dat')
+    src.write(resource_string('hamtools', "ctydat/cty.dat"))
+    dst = str(src) + COMPILED_SUFFIX
+    compiled = CtyDat.compile(str(src), dst)
+    loaded = CtyDat.load_compiled(dst, str(src))
+    for call in ('W1AW', 'TA1AA', 'K0AR', '4Y1CAO', 'W1AW/KH6'):
+        assert loaded.getdxcc(call) == compiled.getdxcc(call)
+    assert loaded.exact == compiled.exact
+
+    # same contents with a new mtime still match by hash
+    src.setmtime(src.mtime() + 10)
+    assert CtyDat.load_compiled(dst, str(src)) is not None
+    src.write('Nowhere:  1:  1:  NA:  0.00:  0.00:  0.0:  X0:\n    X0;\n')
+    assert CtyDat.load_compiled(dst, str(src)) is None
+    assert CtyDat.from_path(str(src)).getdxcc('X0AA').name == 'Nowhere'
+    assert CtyDat.load_compiled(dst, str(src)).dxcc.keys() == ['X0']
+    assert CtyDat.load_compiled(str(tmpdir.join('missing')), str(src)) is None
+
+
+def test_build_dense():
+    ctydat = CtyDat(resource_stream('hamtools', "ctydat/cty.dat"))
+    calls = ['W1AW', 'K', 'KH6XX', 'TA1AA', 'K0AR', 'VK9XX', 'VK9XA',
+             '4Y1CAO', 'AC7N', 'W1AW/KH6', '3D2CR', 'SV/W1AW', 'OH/W1AW']
+    slow = [ctydat.getdxcc(call) for call in calls]
+    ctydat.build_dense()
+    assert ctydat.dense['W'] is ctydat.dxcc['K']
+    assert [ctydat.getdxcc(call) for call in calls] == slow
+    with pytest.raises(InvalidDxcc):
+        ctydat.getdxcc('QQ1AA')
+
+
+def test_manager_reload(tmpdir):
+    src = tmpdir.join('cty.dat')
+    src.write(resource_string('hamtools', "ctydat/cty.dat"))
+    manager = CtyDatManager(str(src), dense=True)
+    old, loaded = manager.ctydat, manager.loaded
+    assert manager.version == '20131229'
+    assert manager.getdxcc('W1AW').prefix == 'K'
+    assert not manager.check()
+
+    src.write('Nowhere:  1:  1:  NA:  0.00:  0.00:  0.0:  X0:\n'
+              '    X0,=VER20200101;\n')
+    src.setmtime(src.mtime() + 10)
+    assert manager.check()
+    assert manager.version == '20200101'
+    assert manager.loaded >= loaded
+    assert manager.getdxcc('X0AA').name == 'Nowhere'
+    # lookups through the old CtyDat are unaffected
+    assert old.getdxcc('W1AW').prefix == 'K'
+
+    src.write('garbage')
+    src.setmtime(src.mtime() + 10)
+    assert not manager.check()
+    assert manager.version == '20200101'
+
+    with manager:
+        assert manager._thread.is_alive()
+    assert manager._thread is None
+
+
+CTY_CSV = """\
+K,United States,291,NA,5,8,37.53,91.67,5.0,AA K N W K0(4)[7];
+KH6,Hawaii,110,OC,31,61,21.15,157.53,10.0,AH6 KH6 =AC7N =KH6XX/W(3)[6];
+"""
+
+CTY_XML = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<clublog date="2014-01-01T00:00:00+00:00" xmlns="http://www.clublog.org/cty/v1.0">
+<entities>
+<entity><adif>291</adif><name>UNITED STATES OF AMERICA</name><prefix>K</prefix><deleted>false</deleted><cqz>5</cqz><cont>NA</cont><long>-91.67</long><lat>37.53</lat></entity>
+<entity><adif>110</adif><name>HAWAII</name><prefix>KH6</prefix><deleted>false</deleted><cqz>31</cqz><cont>OC</cont><long>-157.48</long><lat>21.12</lat></entity>
+<entity><adif>81</adif><name>GERMANY</name><prefix>DL</prefix><deleted>true</deleted><cqz>14</cqz><cont>EU</cont><long>10.00</long><lat>51.00</lat><end>1973-09-16T23:59:59+00:00</end></entity>
+</entities>
+<exceptions>
+<exception record="1"><call>AC7N</call><entity>HAWAII</entity><adif>110</adif><cqz>31</cqz><cont>OC</cont><long>-157.48</long><lat>21.12</lat></exception>
+<exception record="2"><call>KH6OLD</call><entity>HAWAII</entity><adif>110</adif><cqz>31</cqz><cont>OC</cont><long>-157.48</long><lat>21.12</lat><end>2000-01-01T00:00:00+00:00</end></exception>
+</exceptions>
+<prefixes>
+<prefix record="1"><call>K</call><entity>UNITED STATES OF AMERICA</entity><adif>291</adif><cqz>5</cqz><cont>NA</cont><long>-91.67</long><lat>37.53</lat></prefix>
+<prefix record="2"><call>K0</call><entity>UNITED STATES OF AMERICA</entity><adif>291</adif><cqz>4</cqz><cont>NA</cont><long>-91.67</long><lat>37.53</lat></prefix>
+<prefix record="3"><call>KH6</call><entity>HAWAII</entity><adif>110</adif><cqz>31</cqz><cont>OC</cont><long>-157.48</long><lat>21.12</lat></prefix>
+<prefix record="4"><call>DL</call><entity>GERMANY</entity><adif>81</adif><cqz>14</cqz><cont>EU</cont><long>10.00</long><lat>51.00</lat></prefix>
+</prefixes>
+</clublog>
+"""
+
+
+def test_from_csv(ctydat):
+    csvdat = CtyDat.from_csv(StringIO(CTY_CSV))
+    for call in ('W1AW', 'K0AR', 'AC7N', 'KH6AB'):
+        assert csvdat.getdxcc(call) == ctydat.getdxcc(call)
+    assert csvdat.getdxcc('KH6XX/W').cq == '03'
+
+
+def test_from_xml(tmpdir):
+    xmldat = CtyDat.from_xml(StringIO(CTY_XML))
+    assert xmldat.getdxcc('K1ABC') == ('UNITED STATES OF AMERICA', '05', '',
+                                       'NA', '37.53', '91.67', '', 'K')
+    assert xmldat.getdxcc('K0AR').cq == '04'
+    assert xmldat.getdxcc('AC7N').prefix == 'KH6'
+    assert 'KH6OLD' not in xmldat.exact
+    with pytest.raises(InvalidDxcc):
+        xmldat.getdxcc('DL1ABC')
+
+    src = tmpdir.join('cty.xml')
+    src.write(CTY_XML)
+    assert CtyDat.from_path(str(src)).getdxcc('K0AR').cq == '04'
+    assert CtyDat.load_compiled(str(src) + COMPILED_SUFFIX) is not None
+
+
+CTY_1990 = """\
+Fed. Rep. of Germany:     14:  28:  EU:   51.00:   -10.00:    -1.0:  DL:
+    DL,Y2;
+German Dem. Rep.:         14:  28:  EU:   52.00:   -13.00:    -1.0:  Y2:
+    Y2,Y3,=DM2ABC;
+"""
+
+CTY_2000 = """\
+Fed. Rep. of Germany:     14:  28:  EU:   51.00:   -10.00:    -1.0:  DL:
+    DL,Y2,Y3;
+"""
+
+
+def test_getdxcc_when_eras():
+    old = CtyDat(StringIO(CTY_1990))
+    new = CtyDat(StringIO(CTY_2000))
+    ctydat = CtyDat.from_eras([(datetime(2000, 1, 1), new),
+                               (datetime(1950, 1, 1), old)])
+    assert ctydat is new
+    assert ctydat.getdxcc('Y21AA').prefix == 'DL'
+    assert ctydat.getdxcc('Y21AA', datetime(1985, 5, 1)).prefix == 'Y2'
+    assert ctydat.getdxcc('Y21AA', datetime(2005, 5, 1)).prefix == 'DL'
+    assert ctydat.getdxcc('DM2ABC', datetime(1985, 5, 1)).prefix == 'Y2'
+    with pytest.raises(InvalidDxcc):
+        ctydat.getdxcc('DM2ABC', datetime(2005, 5, 1))
+    with pytest.raises(InvalidDxcc):
+        ctydat.getdxcc('Y21AA', datetime(1900, 1, 1))
+    whens = [datetime(1985, 5, 1), datetime(2005, 5, 1)]
+    found = ctydat.getdxcc_many(['Y21AA', 'Y21AA'], whens=whens)
+    assert [d.prefix for d in found] == ['Y2', 'DL']
+
+
+def test_getdxcc_when_xml():
+    xmldat = CtyDat.from_xml(StringIO(CTY_XML), history=True)
+    with pytest.raises(InvalidDxcc):
+        xmldat.getdxcc('DL1ABC')
+    assert xmldat.getdxcc('DL1ABC', datetime(1970, 1, 1)).name == 'GERMANY'
+    # the entity's deletion ends its prefixes too
+    with pytest.raises(InvalidDxcc):
+        xmldat.getdxcc('DL1ABC', datetime(2005, 1, 1))
+    assert xmldat.getdxcc('KH6OLD', datetime(1999, 1, 1)).prefix == 'KH6'
+    assert 'KH6OLD' not in xmldat.exact
+    assert xmldat.getdxcc('K0AR', datetime(1999, 1, 1)).cq == '04'
+
+
+def test_from_path_unwritable(tmpdir, monkeypatch):
+    src = tmpdir.join('cty.dat')
+    src.write(resource_string('hamtools', "ctydat/cty.dat"))
+    # a directory in the way makes the sidecar unwritable, even for root
+    tmpdir.mkdir('cty.dat' + COMPILED_SUFFIX)
+    cachedir = tmpdir.join('cache')
+    monkeypatch.setattr(ctydat_module, 'COMPILED_CACHE_DIR', str(cachedir))
+    parses = []
+    from_data = CtyDat.from_data.im_func
+    monkeypatch.setattr(CtyDat, 'from_data', classmethod(
+        lambda cls, *args: parses.append(args) or from_data(cls, *args)))
+
+    loaded = CtyDat.from_path(str(src))
+    assert loaded.getdxcc('W1AW').prefix == 'K'
+    assert len(parses) == 1
+    assert len(cachedir.listdir()) == 1
+    CtyDat.from_path(str(src))
+    assert len(parses) == 1
+
+    # nowhere writable: parsed once and still returned
+    loaded = CtyDat.from_path(str(src), str(tmpdir.join('cty.dat.compiled')))
+    assert loaded.getdxcc('W1AW').prefix == 'K'
+    assert len(parses) == 2
+
+
+def test_zones_padded(ctydat):
+    for dxcc in ctydat.records.itervalues():
+        assert len(dxcc.cq) == len(dxcc.itu) == 2
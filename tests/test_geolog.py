@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""Geolog tests, run against a stub QRZ.com session and no FCC lookups"""
+import os
+
+from hamtools import geolog
+from hamtools import qrz
+from hamtools.ctydat import CtyDat
+from pkg_resources import resource_stream
+import pytest
+
+ADIF_LOG = """\
+Exported by hand
+<adif_ver:4>1.00
+<eoh>
+<call:4>W1AW<station_callsign:4>N5KO<qso_date:8>20120714<time_on:4>1200<eor>
+<call:5>JA1ZZ<station_callsign:4>N5KO<qso_date:8>20120714<time_on:4>1206<eor>
+"""
+
+CABRILLO_LOG = """\
+START-OF-LOG: 3.0
+CONTEST: ARRL-10
+CALLSIGN: N5KO
+QSO: 28050 CW 2000-12-09 0000 N5KO          599 CA     KO1H          599 ME
+QSO: 28050 CW 2000-12-09 0001 N5KO          599 CA     W1AW          599 CT     1
+END-OF-LOG:
+"""
+
+# no station_callsign or operator, so the op can't be georeferenced
+BROKEN_LOG = """\
+<eoh>
+<call:4>W1AW<qso_date:8>20120714<time_on:4>1200<eor>
+"""
+
+QRZ_LOCATIONS = {
+    'N5KO': dict(lat=37.9, lon=-122.3),
+    'W1AW': dict(lat=41.7, lon=-72.7),
+    'NOLOC': dict(lat=None, lon=None),
+}
+
+
+class StubSession(object):
+    """Answers qrz() from QRZ_LOCATIONS and counts the lookups"""
+    def __init__(self, user=None, passwd=None, cachepath=None, key=None):
+        self.cachepath = cachepath
+        self.key = key or 'stub-key'
+        self.lookups = []
+
+    def qrz(self, callsign):
+        self.lookups.append(callsign)
+        try:
+            return QRZ_LOCATIONS[callsign]
+        except KeyError:
+            raise qrz.NotFound(callsign)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class StubFCCReferencer(object):
+    def reference(self, callsign):
+        raise geolog.NotFound(callsign)
+
+
+@pytest.fixture('module')
+def ctydat():
+    return CtyDat(resource_stream('hamtools', "ctydat/cty.dat"))
+
+
+@pytest.fixture
+def stubbed(monkeypatch):
+    monkeypatch.setattr(qrz, 'Session', StubSession)
+    monkeypatch.setattr(geolog, 'FCCReferencer', StubFCCReferencer)
+    monkeypatch.setattr(geolog, '_worker', {})
+
+
+def write_log(dirpath, name, text):
+    path = dirpath.join(name)
+    path.write(text)
+    return str(path)
+
+
+def test_load_log_sniffs_format(tmpdir):
+    qsolog = geolog.load_log(write_log(tmpdir, 'a.adi', ADIF_LOG))
+    assert qsolog.callsign == 'N5KO'
+    assert [q['call'] for q in qsolog.qsos] == ['W1AW', 'JA1ZZ']
+    assert 'app_datetime_on' not in qsolog.qsos[0]
+
+    qsolog = geolog.load_log(write_log(tmpdir, 'b.log', CABRILLO_LOG))
+    assert qsolog.callsign == 'N5KO'
+    assert [q['call'] for q in qsolog.qsos] == ['KO1H', 'W1AW']
+    assert int(qsolog.qsos[1]['time']) == 1
+
+
+def test_qrz_memo():
+    sess = StubSession()
+    ref = geolog.QrzReferencer(sess)
+    assert ref.reference('W1AW') == (-72.7, 41.7)
+    assert ref.reference('W1AW') == (-72.7, 41.7)
+    for call, exc in (('NOCALL', geolog.NotFound), ('NOLOC', geolog.NullLoc)):
+        for _ in range(2):
+            with pytest.raises(exc):
+                ref.reference(call)
+    assert sess.lookups == ['W1AW', 'NOCALL', 'NOLOC']
+
+
+def test_init_worker(stubbed, ctydat):
+    geolog._init_worker('session-key', '/tmp/cache', ctydat)
+    drivers = geolog._worker['drivers']
+    assert [type(d) for d in drivers] == [geolog.QrzReferencer,
+                                         StubFCCReferencer,
+                                         geolog.CtyDatReferencer]
+    sess = drivers[0].session
+    assert sess.key == 'session-key'
+    assert sess.cachepath == '/tmp/cache'
+    assert drivers[2].ctydat is ctydat
+
+
+def test_geolog_one(stubbed, ctydat, tmpdir):
+    geolog._init_worker('session-key', None, ctydat)
+    good = write_log(tmpdir, 'good.adi', ADIF_LOG)
+    broken = write_log(tmpdir, 'broken.adi', BROKEN_LOG)
+    out = str(tmpdir.join('good'))
+    assert geolog._geolog_one((good, out)) == (good, None)
+    assert os.path.exists(out + '.kml')
+    path, error = geolog._geolog_one((broken, str(tmpdir.join('broken'))))
+    assert path == broken
+    assert 'OperatorGeoRefFail' in error
+
+
+def test_geolog_batch(stubbed, ctydat, tmpdir):
+    logdir = tmpdir.mkdir('logs')
+    write_log(logdir, 'good.adi', ADIF_LOG)
+    write_log(logdir, 'contest.log', CABRILLO_LOG)
+    broken = write_log(logdir, 'broken.adi', BROKEN_LOG)
+    write_log(logdir, '.hidden', BROKEN_LOG)
+    outdir = tmpdir.join('out', 'maps')
+
+    failed = geolog.geolog_batch(str(logdir), str(outdir), 'user', 'pass',
+                                 None, ctydat, jobs=2)
+    assert failed == [broken]
+    assert sorted(p.basename for p in outdir.listdir()) == [
+        'contest.kml', 'contest_lines.geojson', 'contest_points.geojson',
+        'good.kml', 'good_lines.geojson', 'good_points.geojson']
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""Tests for hamtools.qrz"""
+from hamtools import qrz
+import pytest
+
+CALL_XML = """\
+<?xml version="1.0" encoding="utf-8" ?>
+<QRZDatabase version="1.24" xmlns="http://xml.qrz.com">
+  <Callsign>
+    <call>AA7BQ</call>
+    <fname>FRED L</fname>
+    <name>LLOYD</name>
+    <addr2>PHOENIX</addr2>
+    <lat>34.023460</lat>
+    <lon>-111.880500</lon>
+    <grid>DM43bb</grid>
+  </Callsign>
+  <Session>
+    <Key>2331uf894c4bd29f3923f3bacf02c532d7bd9</Key>
+    <Count>123</Count>
+  </Session>
+</QRZDatabase>
+"""
+
+NOT_FOUND_XML = """\
+<?xml version="1.0" encoding="utf-8" ?>
+<QRZDatabase version="1.24" xmlns="http://xml.qrz.com">
+  <Session>
+    <Error>Not found: XX9XX</Error>
+    <Key>2331uf894c4bd29f3923f3bacf02c532d7bd9</Key>
+  </Session>
+</QRZDatabase>
+"""
+
+
+def test_parse_response():
+    fields, session = qrz.parse_response(CALL_XML)
+    assert fields['call'] == 'AA7BQ'
+    assert fields['grid'] == 'DM43bb'
+    assert session == {'Key': '2331uf894c4bd29f3923f3bacf02c532d7bd9',
+                       'Count': '123'}
+    assert qrz.parse_response(qrz.testSessionXML)[0] == {}
+
+
+def test_cached_lookup(tmpdir):
+    with qrz.Session(key='key', cachepath=str(tmpdir.join('cache'))) as sess:
+        sess.db.execute("insert into dict values (?, ?)", ('AA7BQ', CALL_XML))
+        sess.db.execute("insert into dict values (?, ?)",
+                        ('XX9XX', NOT_FOUND_XML))
+        rec = sess.qrz('AA7BQ')
+        assert rec['lat'] == 34.02346
+        assert rec['lon'] == -111.8805
+        assert rec['name'] == 'LLOYD'
+        assert rec['email'] is None
+        with pytest.raises(qrz.NotFound):
+            sess.qrz('XX9XX')